@@ -12,7 +12,6 @@ def read(relative_path):
         return f.read()
 
 dependencies = ["bitstring>=3.1.3",
-                "patricia-trie>=10",
                 "pyyaml>=3.10"]
 
 scm_version_options = {
@@ -2,6 +2,7 @@
 
 import sys
 import logging
+import re
 import string
 import itertools
 from pprint import pprint
@@ -68,6 +69,32 @@ class Pattern(object):
             except UnusedSubset:
                 pass
 
+        # The longest run of characters from a single subset. Within it,
+        # the differences between consecutive bytes are known in advance,
+        # whatever the mapping, so it can be searched for in a rom's deltas.
+        # Failing that, use the closest pair of characters from the same
+        # subset, and deltas between bytes that far apart.
+        self.gap = 1
+        self.keyoffset = 0
+        self.key = b""
+        for domain in lowercase, uppercase, digits:
+            for match in re.finditer("[{}]+".format(domain), self.string):
+                run = match.group()
+                if len(run) - 1 > len(self.key):
+                    self.keyoffset = match.start()
+                    self.key = bytes((ord(b) - ord(a)) % 256
+                                     for a, b in zip(run, run[1:]))
+        if not self.key:
+            for subset in self.subsets:
+                positions = [i for i, c in enumerate(self.string)
+                             if c in subset.string]
+                for i, j in zip(positions, positions[1:]):
+                    if not self.key or j - i < self.gap:
+                        self.gap = j - i
+                        self.keyoffset = i
+                        diff = ord(self.string[j]) - ord(self.string[i])
+                        self.key = bytes([diff % 256])
+
     def _refpoints(self, data):
         for subset in self.subsets:
             refbyte = data[subset.refidx]
@@ -124,6 +151,93 @@ class Pattern(object):
         # If we get here, we have a consistent and mostly-complete map.
         return charset
 
+    def candidates(self, diffs):
+        """ Find offsets where this string might be, given a rom's deltas.
+
+        diffs should be as returned by deltas(data, self.gap). Only offsets
+        matching the pattern's key are returned; if it doesn't have one,
+        that's every offset.
+        """
+        last = len(diffs) + self.gap - self.length
+        if not self.key:
+            yield from range(last + 1)
+            return
+        i = diffs.find(self.key)
+        while i != -1:
+            offset = i - self.keyoffset
+            if 0 <= offset <= last:
+                yield offset
+            i = diffs.find(self.key, i + 1)
+
+    def search(self, data, diffs=None):
+        """ Find everywhere this string could be in data.
+
+        Yields (offset, charset) pairs, in order of offset. diffs may be
+        passed in to avoid recalculating the rom's deltas for each string.
+        """
+        if len(data) < self.length:
+            return
+        if diffs is None:
+            diffs = deltas(data, self.gap)
+        with memoryview(data) as view:
+            for offset in self.candidates(diffs):
+                try:
+                    chunk = view[offset:offset+self.length]
+                    yield offset, self.buildmap(chunk)
+                except NoMapping:
+                    continue
+                finally:
+                    chunk.release()
+
+_DELTA_CHUNK = 2**20
+
+def deltas(data, gap=1):
+    """ Get the differences between bytes of data, modulo 256.
+
+    Byte i of the result is data[i+gap] - data[i]. Relative search works on
+    these, since the deltas of a text string are the same whatever its
+    encoding, as long as the alphabet is contiguous.
+    """
+    out = []
+    for start in range(0, max(len(data) - gap, 0), _DELTA_CHUNK):
+        # Subtract bytewise, eight bits at a time, using the classic SWAR
+        # trick: setting the high bit of each minuend byte and clearing it in
+        # each subtrahend byte stops borrows crossing byte boundaries. The
+        # high bits are then fixed up separately.
+        chunk = data[start:start+_DELTA_CHUNK+gap]
+        size = len(chunk) - gap
+        high = int.from_bytes(b"\x80" * size, 'little')
+        new = int.from_bytes(chunk[gap:], 'little')
+        old = int.from_bytes(chunk[:-gap], 'little')
+        diff = ((new | high) - (old & ~high)) ^ ((new ^ ~old) & high)
+        out.append(diff.to_bytes(size, 'little'))
+    return b"".join(out)
+
+
+def search(data, strings, start=0, stop=None):
+    """ Search data for several strings at once.
+
+    Yields (string, offset, charset) for every possible match, grouped by
+    string in the order given. The rom's deltas are only computed once for
+    each gap the strings need; usually that's just one.
+
+    If start or stop are given, only matches starting in that range are
+    reported. This allows a large image to be searched in pieces.
+    """
+    stop = len(data) if stop is None else min(stop, len(data))
+    end = stop + max((len(s) for s in strings), default=1) - 1
+    diffs = {}
+    with memoryview(data)[start:end] as view:
+        for s in strings:
+            pattern = Pattern(s)
+            if pattern.gap not in diffs:
+                diffs[pattern.gap] = deltas(view, pattern.gap)
+            for offset, charset in pattern.search(view, diffs[pattern.gap]):
+                if start + offset >= stop:
+                    break
+                yield s, start + offset, charset
+
+
 def merge(*dicts):
     out = {}
     for d in dicts:
@@ -134,3 +248,41 @@ def merge(*dicts):
             else:
                 out[k] = v
     return out
+
+
+def merge_candidates(candidates):
+    """ Find every consistent way of merging candidate charsets.
+
+    candidates is a list with one entry per known string, each a list of the
+    charsets that string might imply. Returns a list of every distinct
+    charset that can be made by merging one candidate from each entry
+    without a MappingConflictError.
+
+    This is a backtracking search rather than a trial of every combination.
+    Strings with the fewest candidates go first, candidates that conflict
+    with the charset so far are dropped immediately, and identical partial
+    charsets reached by different routes are only explored once. So the
+    work done depends on how many consistent charsets there are, not on
+    the number of combinations.
+    """
+    lists = sorted((list(c) for c in candidates), key=len)
+    seen = [set() for i in range(len(lists) + 1)]
+    results = []
+
+    def extend(depth, partial):
+        key = frozenset(partial.items())
+        if key in seen[depth]:
+            return
+        seen[depth].add(key)
+        if depth == len(lists):
+            results.append(partial)
+            return
+        for charset in lists[depth]:
+            if any(partial.get(k, v) != v for k, v in charset.items()):
+                continue
+            merged = dict(partial)
+            merged.update(charset)
+            extend(depth + 1, merged)
+
+    extend(0, {})
+    return results
@@ -1,15 +1,42 @@
 """ Classes and utilities for building ROM patches."""
 
+import io
 import os
-import codecs
-import itertools
+import re
+import mmap
+import zlib
+import heapq
+import contextlib
+from bisect import bisect_right
+from struct import pack, unpack_from
+from collections import namedtuple
+from collections.abc import MutableMapping
 
 from . import util
 
-_IPS_HEADER = "PATCH"
-_IPS_FOOTER = "EOF"
-_IPS_BOGO_ADDRESS = 0x454f46
-_IPS_RLE_THRESHOLD = 10  # How many repeats before trying to use RLE?
+# The IPS variants differ only in their markers and offset size. The bogo
+# address is the offset that would read as the footer, so no record may start
+# there. limit is the largest offset a change may have, if any.
+_IPSFormat = namedtuple("_IPSFormat", "name header footer width bogo limit")
+_IPS = _IPSFormat("IPS", b"PATCH", b"EOF", 3, 0x454F46, 0xFFFFFF)
+_IPS32 = _IPSFormat("IPS32", b"IPS32", b"EEOF", 4, 0x45454F46, 0xFFFFFFFF)
+_IPST = _IPS._replace(name="IPST", limit=None)
+_IPS_RLE_THRESHOLD = 4  # Shortest run that can be cheaper as RLE.
+_IPS_RUNS = re.compile(rb"(.)\1{%d,}" % (_IPS_RLE_THRESHOLD - 1), re.DOTALL)
+_IPS_MAX_RECORD = 0xFFFF  # Largest size that fits in a record.
+_WRITE_BUFFER = 2**16  # Bytes of output to collect before writing.
+_BPS_HEADER = b"BPS1"
+_UPS_HEADER = b"UPS1"
+# BPS action types.
+_BPS_SOURCE_READ = 0
+_BPS_TARGET_READ = 1
+_BPS_SOURCE_COPY = 2
+_BPS_TARGET_COPY = 3
+_BPS_MATCH = 8  # Bytes hashed when looking for copies; the shortest copy.
+_BPS_MIN_READ = 4  # Shortest SourceRead worth interrupting a literal for.
+_SOURCE_TYPES = {'bps', 'ups'}  # Formats that need the original ROM.
+_DIFF_CHUNK = 2**20  # Bytes to compare at once when diffing.
+_DIFF_WINDOW = 256   # Granularity to narrow down differing chunks to.
 
 
 class PatchFormatError(Exception):
@@ -22,139 +49,1021 @@ class PatchValueError(Exception):
     pass
 
 
+class ChangeSet(MutableMapping):
+    """ A sparse set of byte changes, stored as sorted runs.
+
+    This behaves like a dictionary mapping offsets to byte values, which is
+    how the rest of romlib likes to think about patches. Internally,
+    contiguous changes are kept together as a single run of bytes, and the
+    runs are kept sorted by start offset. Point lookups and writes are a
+    binary search away, and merging or writing out a patch never needs to
+    touch individual bytes.
+
+    Runs never overlap and never touch; writing a run adjacent to an existing
+    one merges the two.
+    """
+    def __init__(self, data=None):
+        self._starts = []  # Start offset of each run.
+        self._runs = []    # Bytearray contents of each run.
+        if data is not None:
+            self.update(data)
+
+    @classmethod
+    def from_blocks(cls, blocks):
+        """ Create a changeset from an offset-to-bytes dictionary."""
+        changes = cls()
+        for start, data in sorted(blocks.items()):
+            changes.write(start, data)
+        return changes
+
+    @classmethod
+    def from_records(cls, records):
+        """ Create a changeset from an iterable of (offset, bytes) records.
+
+        Records are applied in order, so later ones win where they overlap.
+        """
+        changes = cls()
+        for offset, data in records:
+            changes.write(offset, data)
+        return changes
+
+    def _find(self, offset):
+        """ Get the index of the run containing offset, or None."""
+        i = bisect_right(self._starts, offset) - 1
+        if i >= 0 and offset < self._starts[i] + len(self._runs[i]):
+            return i
+        return None
+
+    def write(self, offset, data):
+        """ Overlay a block of changes starting at offset.
+
+        Existing changes in the same range are replaced. Runs that the new
+        data overlaps or touches are merged with it.
+        """
+        if not data:
+            return
+        starts = self._starts
+        runs = self._runs
+        end = offset + len(data)
+
+        # First run that overlaps or touches the new one, and the last run
+        # that does.
+        first = bisect_right(starts, offset) - 1
+        if first < 0 or starts[first] + len(runs[first]) < offset:
+            first += 1
+        last = bisect_right(starts, end) - 1
+
+        if first > last:
+            # Nothing nearby; this is a new run.
+            starts.insert(first, offset)
+            runs.insert(first, bytearray(data))
+            return
+
+        head = starts[first]
+        if first == last and head + len(runs[first]) >= end:
+            # Entirely inside (or flush with) an existing run; patch it in
+            # place.
+            if head <= offset:
+                runs[first][offset-head:end-head] = data
+                return
+
+        block = bytearray()
+        if head < offset:
+            block += runs[first][:offset-head]
+        block += data
+        tail = starts[last] + len(runs[last])
+        if tail > end:
+            block += runs[last][end-starts[last]:]
+        starts[first:last+1] = [min(head, offset)]
+        runs[first:last+1] = [block]
+
+    @property
+    def end(self):
+        """ The offset just past the last change, or 0 if there are none."""
+        if not self._runs:
+            return 0
+        return self._starts[-1] + len(self._runs[-1])
+
+    def blocks(self, start=None, stop=None):
+        """ Iterate over (offset, bytes) pairs for each run, in order.
+
+        If start or stop are given, only changes inside that range are
+        included, and runs crossing its edges are clipped to it.
+        """
+        if start is None and stop is None:
+            for offset, run in zip(self._starts, self._runs):
+                yield offset, bytes(run)
+            return
+        start = 0 if start is None else start
+        first = max(bisect_right(self._starts, start) - 1, 0)
+        for i in range(first, len(self._runs)):
+            offset, run = self._starts[i], self._runs[i]
+            if stop is not None and offset >= stop:
+                break
+            end = offset + len(run)
+            if end <= start:
+                continue
+            lo = max(offset, start)
+            hi = end if stop is None else min(end, stop)
+            yield lo, bytes(run[lo-offset:hi-offset])
+
+    def update(self, other):
+        """ Merge in other changes. Later changes win, as with a dict.
+
+        other may be another ChangeSet, a mapping of offsets to byte values,
+        or an iterable of (offset, value) pairs.
+        """
+        if isinstance(other, ChangeSet):
+            for start, run in zip(other._starts, other._runs):
+                self.write(start, run)
+            return
+        if hasattr(other, 'items'):
+            other = other.items()
+        # Group contiguous offsets so they go in as one run.
+        block = bytearray()
+        start = None
+        for offset, value in sorted(other):
+            if start is not None and offset == start + len(block):
+                block.append(value)
+                continue
+            if start is not None:
+                self.write(start, block)
+            block = bytearray((value,))
+            start = offset
+        if start is not None:
+            self.write(start, block)
+
+    def copy(self):
+        """ Get a copy of the changeset."""
+        return type(self)(self)
+
+    def __getitem__(self, offset):
+        i = self._find(offset)
+        if i is None:
+            raise KeyError(offset)
+        return self._runs[i][offset-self._starts[i]]
+
+    def __setitem__(self, offset, value):
+        i = self._find(offset)
+        if i is not None:
+            self._runs[i][offset-self._starts[i]] = value
+        else:
+            self.write(offset, bytes((value,)))
+
+    def __delitem__(self, offset):
+        i = self._find(offset)
+        if i is None:
+            raise KeyError(offset)
+        start = self._starts[i]
+        run = self._runs[i]
+        split = offset - start
+        starts = []
+        runs = []
+        if split > 0:
+            starts.append(start)
+            runs.append(run[:split])
+        if split + 1 < len(run):
+            starts.append(offset + 1)
+            runs.append(run[split+1:])
+        self._starts[i:i+1] = starts
+        self._runs[i:i+1] = runs
+
+    def __contains__(self, offset):
+        return isinstance(offset, int) and self._find(offset) is not None
+
+    def __iter__(self):
+        for start, run in zip(self._starts, self._runs):
+            yield from range(start, start + len(run))
+
+    def __len__(self):
+        return sum(len(run) for run in self._runs)
+
+    def __repr__(self):
+        return "{}({})".format(type(self).__name__, dict(self.blocks()))
+
+
+def _diffruns(old, new, offset=0):
+    """ Find runs of bytes that differ between two equal-length buffers.
+
+    Yields (offset, data) pairs, where data is the contents of the run in
+    new. The buffers are compared a window at a time, and only windows that
+    differ are examined byte by byte.
+
+    offset is added to the offsets yielded, for callers that are diffing a
+    piece of something larger.
+    """
+    start = None  # Start of the current run, relative to the buffers.
+    for pos in range(0, len(new), _DIFF_WINDOW):
+        window1 = old[pos:pos+_DIFF_WINDOW]
+        window2 = new[pos:pos+_DIFF_WINDOW]
+        if window1 == window2:
+            if start is not None:
+                yield offset + start, bytes(new[start:pos])
+                start = None
+            continue
+        for i, (byte1, byte2) in enumerate(zip(window1, window2), pos):
+            if byte1 != byte2 and start is None:
+                start = i
+            elif byte1 == byte2 and start is not None:
+                yield offset + start, bytes(new[start:i])
+                start = None
+    if start is not None:
+        yield offset + start, bytes(new[start:])
+
+
+def _diffbuffers(old, new, size=None):
+    """ Find runs of bytes that differ between two buffers of any size.
+
+    Yields (offset, data) pairs, like _diffruns. The buffers are compared a
+    chunk at a time and identical chunks are skipped outright. A buffer that
+    is shorter than the other is treated as if it were padded with zeroes.
+    Only the first size bytes are compared, if size is given.
+
+    Runs are maximal even where they cross chunk boundaries; the delta
+    formats count on runs never touching.
+    """
+    if size is None:
+        size = max(len(old), len(new))
+    # The last run found, which may continue into the next chunk.
+    start = end = None
+    pieces = []
+    for pos in range(0, size, _DIFF_CHUNK):
+        stop = min(pos + _DIFF_CHUNK, size)
+        chunk1 = old[pos:stop]
+        chunk2 = new[pos:stop]
+        if chunk1 == chunk2:
+            continue
+        length = stop - pos
+        chunk1 = bytes(chunk1).ljust(length, b"\0")
+        chunk2 = bytes(chunk2).ljust(length, b"\0")
+        for offset, data in _diffruns(chunk1, chunk2, pos):
+            if offset == end:
+                pieces.append(data)
+            else:
+                if pieces:
+                    yield start, b"".join(pieces)
+                start, pieces = offset, [data]
+            end = offset + len(data)
+    if pieces:
+        yield start, b"".join(pieces)
+
+
+def _xor(data1, data2):
+    """ XOR two equal-length byte strings together."""
+    value = int.from_bytes(data1, 'big') ^ int.from_bytes(data2, 'big')
+    return value.to_bytes(len(data1), 'big')
+
+
+def filter_blocks(blocks, orig):
+    """ Remove no-ops from a stream of (offset, bytes) blocks.
+
+    orig is a buffer holding the original data, e.g. from util.filebuffer.
+    Blocks are compared against it whole, and only blocks that differ are
+    narrowed down. Changes past the end of orig are never no-ops.
+    """
+    for start, data in blocks:
+        current = orig[start:start+len(data)]
+        if current == data:
+            continue
+        if len(data) == 1:
+            # Common for scattered edits, and needs no diffing.
+            yield start, data
+            continue
+        inside = len(current)
+        yield from _diffruns(current, data[:inside], start)
+        if inside < len(data):
+            yield start + inside, data[inside:]
+
+
+def merge(sources, conflicts=None):
+    """ Merge several streams of (offset, bytes) blocks into one.
+
+    Each source must be sorted by offset and free of overlaps, as from
+    ChangeSet.blocks(). The result is produced as the sources are read, and
+    is sorted and overlap-free too. Where sources overlap, the later source
+    wins, byte by byte.
+
+    If conflicts is a list, a (start, end, sources) tuple is appended to it
+    for each range where sources overlap and disagree; sources is a sorted
+    list of the indexes of the sources involved.
+    """
+    def tag(index, blocks):
+        for offset, data in blocks:
+            yield offset, index, data
+
+    streams = [tag(i, blocks) for i, blocks in enumerate(sources)]
+    cluster = []  # Blocks that overlap or touch, waiting to be merged.
+    end = None    # End of the cluster.
+    for offset, index, data in heapq.merge(*streams):
+        if cluster and offset > end:
+            yield _merge_cluster(cluster, end, conflicts)
+            cluster = []
+        if not cluster:
+            end = offset
+        cluster.append((offset, index, data))
+        end = max(end, offset + len(data))
+    if cluster:
+        yield _merge_cluster(cluster, end, conflicts)
+
+
+def _merge_cluster(cluster, end, conflicts):
+    """ Merge a cluster of overlapping blocks for merge()."""
+    if len(cluster) == 1:
+        offset, index, data = cluster[0]
+        return offset, data
+    start = cluster[0][0]
+    merged = bytearray(end - start)
+    for offset, index, data in sorted(cluster, key=lambda item: item[1]):
+        merged[offset-start:offset-start+len(data)] = data
+    if conflicts is not None:
+        # Sweep through the cluster in offset order, comparing each block
+        # only with earlier blocks that are still open. Sources don't
+        # overlap themselves, so there's at most one open block per source.
+        found = []
+        active = []
+        for offset2, index2, data2 in cluster:
+            active = [block for block in active
+                      if block[0] + len(block[2]) > offset2]
+            for offset1, index1, data1 in active:
+                if index1 == index2:
+                    continue
+                low = offset2
+                high = min(offset1 + len(data1), offset2 + len(data2))
+                old = data1[low-offset1:high-offset1]
+                new = data2[low-offset2:high-offset2]
+                for offset, data in _diffruns(old, new, low):
+                    found.append((offset, offset + len(data),
+                                  {index1, index2}))
+            active.append((offset2, index2, data2))
+        # Report each stretch of conflicting bytes once, with every source
+        # that had a hand in it.
+        found.sort(key=lambda item: item[0])
+        for low, high, indexes in found:
+            if conflicts and conflicts[-1][1] >= low:
+                last_low, last_high, last_indexes = conflicts[-1]
+                conflicts[-1] = (last_low, max(last_high, high),
+                                 sorted(indexes.union(last_indexes)))
+            else:
+                conflicts.append((low, high, sorted(indexes)))
+    return start, bytes(merged)
+
+
+def apply_blocks(blocks, f):
+    """ Write a list of (offset, bytes) blocks to a file object.
+
+    This is the guts of Patch.apply, split out so that a patch being applied
+    to many files only has to be broken into blocks once. blocks must be
+    sorted by offset, as ChangeSet.blocks() produces them.
+
+    Real files are extended if necessary and then written through a memory
+    map. Anything that can't be mapped is written with seek/write instead.
+    """
+    if not blocks:
+        return
+    try:
+        fileno = f.fileno()
+    except (AttributeError, io.UnsupportedOperation):
+        fileno = None
+    if fileno is None:
+        for offset, block in blocks:
+            f.seek(offset)
+            f.write(block)
+        return
+
+    offset, block = blocks[-1]
+    end = offset + len(block)
+    f.flush()
+    if os.fstat(fileno).st_size < end:
+        # Mappings can't grow the file, so do it first. The gap is zero-filled
+        # the same way seeking past the end and writing would be.
+        f.truncate(end)
+    with mmap.mmap(fileno, 0) as buf:
+        for offset, block in blocks:
+            buf[offset:offset+len(block)] = block
+        buf.flush()
+
+
+def read_ips(f):
+    """ Iterate over the records in an ips or ips32 patch file.
+
+    Yields (offset, bytes) pairs in file order; RLE records are expanded.
+    The variant is detected from the header. The file is mapped rather than
+    read where possible, so this runs in constant memory no matter how large
+    the patch is.
+    """
+    with util.filebuffer(f) as buf, memoryview(buf) as view:
+        header = bytes(view[:5])
+        try:
+            fmt = next(fmt for fmt in (_IPS, _IPS32)
+                       if header == fmt.header)
+        except StopIteration:
+            raise PatchFormatError("Header mismatch reading IPS file.")
+        width = fmt.width
+        pos = len(fmt.header)
+        size = len(view)
+        while True:
+            # Check for EOF marker
+            if view[pos:pos+width] == fmt.footer:
+                break
+            if pos + width + 2 > size:
+                raise PatchFormatError("{} file ended before EOF marker."
+                                       .format(fmt.name))
+
+            # Start reading a record.
+            offset = int.from_bytes(view[pos:pos+width], 'big')
+            length, = unpack_from(">H", view, pos + width)
+            pos += width + 2
+
+            # If size is greater than zero, we have a normal record. If it's
+            # zero, we have an RLE record.
+            if length > 0:
+                data = bytes(view[pos:pos+length])
+                pos += length
+            else:
+                if pos + 3 > size:
+                    raise PatchFormatError("{} RLE record at {:06X} is "
+                                           "truncated.".format(fmt.name,
+                                                               offset))
+                length, value = unpack_from(">HB", view, pos)
+                data = bytes((value,)) * length
+                pos += 3
+            if pos > size:
+                raise PatchFormatError("{} record at {:06X} is truncated."
+                                       .format(fmt.name, offset))
+            yield offset, data
+
+
+def read_ipst(f):
+    """ Iterate over the records in an ipst patch file.
+
+    Yields (offset, bytes) pairs in file order; RLE records are expanded.
+    """
+    # Skip empty or commented lines.
+    f = (line for line in f if not line or not line.startswith("#"))
+
+    header = next(f).rstrip()
+    if header != _IPST.header.decode():
+        raise PatchFormatError("Header mismatch reading IPST file.")
+
+    for line_number, line in enumerate(f, 2):
+        line = line.rstrip()
+        # Check for EOF marker
+        if line == _IPST.footer.decode():
+            break
+
+        # Normal records have three parts, RLE records have four.
+        parts = line.split(":")
+        if len(parts) == 3:
+            offset, size, data = parts
+            if len(data) != int(size, 16) * 2:
+                msg = "Data length doesn't match size on line %s."
+                raise ValueError(msg, line_number)
+            yield int(offset, 16), bytes.fromhex(data)
+        elif len(parts) == 4:
+            offset, size, rle_size, value = [int(part, 16)
+                                             for part in parts]
+            if value > 0xFF:
+                msg = ("Line {}: RLE value {:02X} "
+                       "won't fit in one byte.")
+                raise PatchValueError(msg.format(line_number, value))
+            yield offset, bytes((value,)) * rle_size
+        else:
+            msg = "Line {}: IPST format error."
+            raise PatchFormatError(msg.format(line_number))
+
+
+def _ips_plan(offset, data, fmt=None):
+    """ Find the cheapest way to write a block as a series of IPS records.
+
+    Returns a list of (start, size, rle) tuples, with start relative to the
+    beginning of the block. fmt is the IPS variant, defaulting to plain IPS.
+
+    A literal record costs its offset and size fields plus its data; an RLE
+    record costs three bytes more than the fields no matter how long it is.
+    The only places it can pay to end a record are the edges of runs long
+    enough to be worth RLE, so the block is broken into alternating stretches
+    of literal data and long runs, and a dynamic program picks which runs to
+    pull out as RLE records.
+
+    No record may start at the bogo address, so splits there are never
+    considered. The caller is responsible for blocks that start there.
+    """
+    fmt = fmt or _IPS
+    literal_cost = fmt.width + 2
+    rle_cost = fmt.width + 5
+    tokens = []  # (start, end, is_run)
+    pos = 0
+    for match in _IPS_RUNS.finditer(data):
+        if match.start() > pos:
+            tokens.append((pos, match.start(), False))
+        tokens.append((match.start(), match.end(), True))
+        pos = match.end()
+    if pos < len(data):
+        tokens.append((pos, len(data), False))
+
+    # best[t] is the cost of the cheapest encoding of the first t tokens, and
+    # back[t] says where its last record starts and whether it's RLE.
+    best = [0] * (len(tokens) + 1)
+    back = [None] * (len(tokens) + 1)
+    literal_min = None  # Lowest (best[s] - start of token s) seen so far.
+    literal_from = None
+    for t, (start, end, is_run) in enumerate(tokens, 1):
+        s = t - 1
+        allowed = offset + start != fmt.bogo
+        if allowed and (literal_min is None or best[s] - start < literal_min):
+            literal_min = best[s] - start
+            literal_from = s
+        best[t] = literal_min + literal_cost + end
+        back[t] = (literal_from, False)
+        if is_run and allowed:
+            rle_records = util.divup(end - start, _IPS_MAX_RECORD)
+            cost = best[s] + rle_cost * rle_records
+            if cost < best[t]:
+                best[t] = cost
+                back[t] = (s, True)
+
+    plan = []
+    t = len(tokens)
+    while t > 0:
+        s, rle = back[t]
+        start = tokens[s][0]
+        plan.append((start, tokens[t-1][1] - start, rle))
+        t = s
+    plan.reverse()
+    return plan
+
+
+def _ips_records(blocks, bogobyte=None, fmt=None):
+    """ Break blocks of changes into valid IPS records.
+
+    This is a helper function for writing variants of IPS; fmt says which,
+    defaulting to plain IPS. It yields (offset, data, rle) tuples, where rle
+    indicates that the record should be written as RLE. Each block is split
+    into whatever mix of literal and RLE records makes the patch smallest.
+
+    No record may start at the bogo address (0x454F46 for IPS), because it
+    would be read as the EOF marker. Blocks that start there are moved back
+    one byte, using bogobyte as the value of the byte before them. No record
+    may be longer than 65535 bytes, either, so longer records are split.
+
+    Changes past the largest offset the variant can address raise
+    PatchValueError as soon as they're seen.
+    """
+    fmt = fmt or _IPS
+    for offset, data in blocks:
+        if fmt.limit is not None and offset + len(data) - 1 > fmt.limit:
+            msg = ("Change at 0x{:X} is past the end of the {} address space "
+                   "(0x{:X}); use a format that supports larger files, such "
+                   "as ips32.")
+            raise PatchValueError(msg.format(max(offset, fmt.limit + 1),
+                                             fmt.name, fmt.limit))
+        # Deal with bogoaddress issues.
+        if offset == fmt.bogo:
+            if bogobyte is None:
+                msg = ("A change started at 0x{:X} ({}) "
+                       "but a valid bogobyte was not provided.")
+                raise PatchValueError(msg.format(fmt.bogo,
+                                                 fmt.footer.decode()))
+            offset -= 1
+            data = bogobyte.to_bytes(1, "big") + data
+
+        for start, length, rle in _ips_plan(offset, data, fmt):
+            pos = start
+            stop = start + length
+            while pos < stop:
+                size = min(stop - pos, _IPS_MAX_RECORD)
+                if offset + pos + size == fmt.bogo and pos + size < stop:
+                    # Don't start the next piece on the bogo address.
+                    size -= 1
+                yield offset + pos, data[pos:pos+size], rle
+                pos += size
+
+
+def write_ips(f, blocks, bogobyte=None, fmt=None):
+    """ Write (offset, bytes) blocks to an ips patch file.
+
+    blocks may be any iterable, including a generator; records are encoded
+    as they arrive and written out in large buffered chunks. fmt selects the
+    IPS variant; see write_ips32.
+    """
+    fmt = fmt or _IPS
+    out = bytearray(fmt.header)
+    for offset, data, rle in _ips_records(blocks, bogobyte, fmt):
+        out += offset.to_bytes(fmt.width, 'big')
+        if rle:
+            # Size is zero for RLE
+            out += pack(">HHB", 0, len(data), data[0])
+        else:
+            out += pack(">H", len(data))
+            out += data
+        if len(out) >= _WRITE_BUFFER:
+            f.write(out)
+            out.clear()
+    out += fmt.footer
+    f.write(out)
+
+
+def write_ips32(f, blocks, bogobyte=None):
+    """ Write (offset, bytes) blocks to an ips32 patch file.
+
+    IPS32 is IPS with four-byte offsets, for files larger than 16MB. It uses
+    "IPS32" and "EEOF" as its header and footer.
+    """
+    write_ips(f, blocks, bogobyte, _IPS32)
+
+
+def write_ipst(f, blocks, bogobyte=None):
+    """ Write (offset, bytes) blocks to an ipst patch file.
+
+    Offsets in ipst files are plain hex, so unlike ips they have no size
+    limit.
+    """
+    lines = [_IPST.header.decode()]
+    size = 0
+    for offset, data, rle in _ips_records(blocks, bogobyte, _IPST):
+        if rle:
+            fmt = "{:06X}:{:04X}:{:04X}:{:01X}"
+            line = fmt.format(offset, 0, len(data), data[0])
+        else:
+            fmt = "{:06X}:{:04X}:{}"
+            line = fmt.format(offset, len(data), data.hex().upper())
+        lines.append(line)
+        size += len(line)
+        if size >= _WRITE_BUFFER:
+            f.write("\n".join(lines) + "\n")
+            lines.clear()
+            size = 0
+    lines.append(_IPST.footer.decode())
+    f.write("\n".join(lines) + "\n")
+
+
+def _varint(number):
+    """ Encode a number in the variable-length format used by BPS and UPS."""
+    if number < 0:
+        raise ValueError("Can't encode negative number {}".format(number))
+    out = bytearray()
+    while True:
+        low = number & 0x7F
+        number >>= 7
+        if number == 0:
+            out.append(0x80 | low)
+            return out
+        out.append(low)
+        number -= 1
+
+
+def _read_varint(view, pos):
+    """ Decode a BPS/UPS number at pos. Returns the number and the new pos."""
+    number = 0
+    shift = 1
+    while True:
+        byte = view[pos]
+        pos += 1
+        number += (byte & 0x7F) * shift
+        if byte & 0x80:
+            return number, pos
+        shift <<= 7
+        number += shift
+
+
+def _signed_varint(number):
+    """ Encode a relative offset; the low bit is the sign."""
+    return _varint(abs(number) << 1 | (number < 0))
+
+
+def _read_signed_varint(view, pos):
+    number, pos = _read_varint(view, pos)
+    return (-1 if number & 1 else 1) * (number >> 1), pos
+
+
+def _matchlen(data1, pos1, data2, pos2):
+    """ Count how many bytes match starting at data1[pos1] and data2[pos2].
+
+    Compares in exponentially growing slices rather than byte by byte.
+    """
+    limit = min(len(data1) - pos1, len(data2) - pos2)
+    length = 0
+    step = 16
+    while length < limit:
+        step = min(step, limit - length)
+        if (data1[pos1+length:pos1+length+step]
+                == data2[pos2+length:pos2+length+step]):
+            length += step
+            step *= 2
+        elif step == 1:
+            break
+        else:
+            step //= 2
+    return length
+
+
+def _delta_footer(view, magic, fmt):
+    """ Check a BPS/UPS header and patch checksum; return the other two CRCs.
+
+    Both formats end with the source, target and patch CRC32s, in that order.
+    """
+    if bytes(view[:4]) != magic:
+        raise PatchFormatError("Header mismatch reading {} file.".format(fmt))
+    if len(view) < len(magic) + 12:
+        raise PatchFormatError("{} file is truncated.".format(fmt))
+    source_crc, target_crc, patch_crc = unpack_from("<III", view,
+                                                    len(view) - 12)
+    if zlib.crc32(view[:-4]) != patch_crc:
+        raise PatchFormatError("{} patch checksum mismatch; the patch file "
+                               "is corrupt.".format(fmt))
+    return source_crc, target_crc
+
+
+def _check_source(source, size, crc, fmt):
+    if len(source) != size or zlib.crc32(source) != crc:
+        raise PatchValueError("ROM doesn't match the {} patch's source "
+                              "checksum.".format(fmt))
+
+
+def read_bps(f, source):
+    """ Apply a bps patch file to source and return the target.
+
+    source may be any buffer, e.g. from util.filebuffer. The source, target
+    and patch checksums are all verified.
+    """
+    with util.filebuffer(f) as buf, memoryview(buf) as view:
+        source_crc, target_crc = _delta_footer(view, _BPS_HEADER, "BPS")
+        end = len(view) - 12
+        try:
+            source_size, pos = _read_varint(view, 4)
+            target_size, pos = _read_varint(view, pos)
+            _check_source(source, source_size, source_crc, "BPS")
+            metadata_size, pos = _read_varint(view, pos)
+            pos += metadata_size
+
+            target = bytearray(target_size)
+            out = 0
+            source_rel = 0
+            target_rel = 0
+            while pos < end:
+                action, pos = _read_varint(view, pos)
+                length = (action >> 2) + 1
+                action &= 3
+                if out + length > target_size:
+                    raise PatchFormatError("BPS action writes past the end of "
+                                           "the target.")
+                if action == _BPS_SOURCE_READ:
+                    data = source[out:out+length]
+                elif action == _BPS_TARGET_READ:
+                    # Copy, so no slice of the mapped file outlives it.
+                    data = bytes(view[pos:pos+length])
+                    pos += length
+                elif action == _BPS_SOURCE_COPY:
+                    distance, pos = _read_signed_varint(view, pos)
+                    source_rel += distance
+                    data = source[source_rel:source_rel+length]
+                    source_rel += length
+                else:
+                    distance, pos = _read_signed_varint(view, pos)
+                    target_rel += distance
+                    if not 0 <= target_rel < out:
+                        raise PatchFormatError("Bad BPS target copy.")
+                    # The copy may overlap the data it produces, so copy in
+                    # pieces no longer than the distance between the two.
+                    stop = out + length
+                    while out < stop:
+                        size = min(stop - out, out - target_rel)
+                        target[out:out+size] = target[target_rel:
+                                                      target_rel+size]
+                        out += size
+                        target_rel += size
+                    continue
+                if len(data) != length:
+                    raise PatchFormatError("BPS action reads past the end of "
+                                           "its input.")
+                target[out:out+length] = data
+                out += length
+        except IndexError:
+            raise PatchFormatError("BPS file is truncated.")
+    if out != target_size or zlib.crc32(target) != target_crc:
+        raise PatchFormatError("BPS target checksum mismatch.")
+    return target
+
+
+def write_bps(f, source, target):
+    """ Write a bps patch that turns source into target.
+
+    Unchanged bytes become SourceRead actions. Elsewhere, the encoder hashes
+    every _BPS_MATCH bytes of the source, and of the target written so far,
+    and looks up each target position in those indexes to find data that can
+    be copied from elsewhere instead of stored literally. Because the indexes
+    are sampled, matches are extended backwards as well as forwards once
+    found.
+    """
+    width = _BPS_MATCH
+    out = bytearray(_BPS_HEADER)
+    out += _varint(len(source))
+    out += _varint(len(target))
+    out += _varint(0)  # No metadata.
+
+    source_index = {}
+    for pos in range(0, len(source) - width + 1, width):
+        source_index.setdefault(bytes(source[pos:pos+width]), pos)
+    target_index = {}
+    indexed = 0  # Target positions below this have been indexed.
+
+    source_rel = 0
+    target_rel = 0
+    literal = 0  # Start of pending TargetRead data.
+    pos = 0
+    size = len(target)
+
+    def flush(stop):
+        if literal < stop:
+            out.extend(_varint((stop - literal - 1) << 2 | _BPS_TARGET_READ))
+            out.extend(target[literal:stop])
+
+    while pos < size:
+        # Unchanged data can be read straight from the source. Short runs
+        # aren't worth interrupting a literal for.
+        if pos < len(source) and source[pos] == target[pos]:
+            run = _matchlen(source, pos, target, pos)
+            if run >= _BPS_MIN_READ or literal == pos or pos + run == size:
+                flush(pos)
+                out += _varint((run - 1) << 2 | _BPS_SOURCE_READ)
+                pos += run
+                literal = pos
+                continue
+
+        while indexed + width <= pos:
+            target_index[bytes(target[indexed:indexed+width])] = indexed
+            indexed += width
+
+        key = bytes(target[pos:pos+width])
+        best = (0, None, None)  # length, action, start
+        start = source_index.get(key)
+        if start is not None:
+            best = (_matchlen(source, start, target, pos),
+                    _BPS_SOURCE_COPY, start)
+        start = target_index.get(key)
+        if start is not None:
+            length = _matchlen(target, start, target, pos)
+            if length > best[0]:
+                best = (length, _BPS_TARGET_COPY, start)
+
+        length, action, start = best
+        if length < width:
+            pos += 1
+            continue
+
+        buf = source if action == _BPS_SOURCE_COPY else target
+        while (pos > literal and start > 0
+               and buf[start-1] == target[pos-1]):
+            start -= 1
+            pos -= 1
+            length += 1
+        flush(pos)
+        out += _varint((length - 1) << 2 | action)
+        if action == _BPS_SOURCE_COPY:
+            out += _signed_varint(start - source_rel)
+            source_rel = start + length
+        else:
+            out += _signed_varint(start - target_rel)
+            target_rel = start + length
+        pos += length
+        literal = pos
+    flush(size)
+
+    out += pack("<II", zlib.crc32(source), zlib.crc32(target))
+    out += pack("<I", zlib.crc32(out))
+    f.write(out)
+
+
+def read_ups(f, source):
+    """ Apply a ups patch file to source and return the target.
+
+    source may be any buffer, e.g. from util.filebuffer. The source, target
+    and patch checksums are all verified.
+    """
+    with util.filebuffer(f) as buf, memoryview(buf) as view:
+        source_crc, target_crc = _delta_footer(view, _UPS_HEADER, "UPS")
+        end = len(view) - 12
+        try:
+            source_size, pos = _read_varint(view, 4)
+            target_size, pos = _read_varint(view, pos)
+            _check_source(source, source_size, source_crc, "UPS")
+
+            # Bytes past the end of the source count as zero.
+            target = bytearray(target_size)
+            common = min(len(source), target_size)
+            target[:common] = source[:common]
+            out = 0
+            while pos < end:
+                skip, pos = _read_varint(view, pos)
+                out += skip
+                stop = buf.find(b"\0", pos, end)
+                if stop < 0:
+                    raise PatchFormatError("Unterminated UPS record.")
+                length = stop - pos
+                if out + length > target_size:
+                    raise PatchFormatError("UPS record writes past the end "
+                                           "of the target.")
+                target[out:out+length] = _xor(target[out:out+length],
+                                              view[pos:stop])
+                # The terminator stands for one unchanged byte.
+                out += length + 1
+                pos = stop + 1
+        except IndexError:
+            raise PatchFormatError("UPS file is truncated.")
+    if zlib.crc32(target) != target_crc:
+        raise PatchFormatError("UPS target checksum mismatch.")
+    return target
+
+
+def write_ups(f, source, target):
+    """ Write a ups patch that turns source into target."""
+    out = bytearray(_UPS_HEADER)
+    out += _varint(len(source))
+    out += _varint(len(target))
+    pos = 0
+    for offset, data in _diffbuffers(source, target, len(target)):
+        old = bytes(source[offset:offset+len(data)]).ljust(len(data), b"\0")
+        out += _varint(offset - pos)
+        out += _xor(old, data)
+        out += b"\0"
+        pos = offset + len(data) + 1
+    out += pack("<II", zlib.crc32(source), zlib.crc32(target))
+    out += pack("<I", zlib.crc32(out))
+    f.write(out)
+
+
 class Patch(object):
     """ A ROM patch."""
     def __init__(self, data=None, rom=None):
         """ Create a Patch.
 
-        data: A dictionary of changes to be made.
+        data: A dictionary or ChangeSet of changes to be made.
         rom: A rom to filter the changes against. Any changes that are
              no-ops will be removed. Note that this is optional and can
              also be done manually with Patch.filter.
         """
-        if data is None:
-            data = {}
-        self.changes = data.copy()
+        self.changes = ChangeSet(data)
         if rom:
             self.filter(rom)
 
-    @classmethod
-    def _blockify(cls, changes):
-        """ Convert canonical changes to bytes object changes.
-
-        The idea is to merge adjacent changes into a single change object.
-        This would normally be done before writing out a patch so the patch
-        is not huge. Romlib's internal format only stores individual byte
-        changes because bytes objects are harder to merge, filter, etc.
-        """
-
-        merged = {}
-        block = bytearray()  # Current block contents.
-        start = None         # Start of current block.
-        last = None        # Offset of last change seen.
-        for offset, value in sorted(changes.items()):
-            if start is None:
-                # First entry.
-                block.append(value)
-                start = offset
-                last = offset
-            elif offset == last + 1:
-                # Adjacent change.
-                block.append(value)
-                last = offset
-            else:
-                # Nonadjacent change. Store the current change block and start
-                # a new one.
-                merged[start] = block
-                block = bytearray()
-                block.append(value)
-                start = offset
-                last = offset
-        if start is not None:
-            # Make sure the last block gets merged.
-            merged[start] = block
-        return merged
-
     @classmethod
     def from_blocks(cls, blocks):
         """ Load an offset-to-bytes-object dictionary. """
-        changes = {}
-        for start, data in blocks.items():
-            for i, byte in enumerate(data):
-                changes[start+i] = byte
-        return Patch(changes)
+        return Patch(ChangeSet.from_blocks(blocks))
 
     @classmethod
-    def from_ips(cls, f):
-        """ Load an ips patch file. """
-        # Read and check the header
-        header = f.read(5)
-        if codecs.decode(header) != _IPS_HEADER:
-            raise PatchFormatError("Header mismatch reading IPS file.")
-
-        changes = {}
-        while True:
-            # Check for EOF marker
-            data = f.read(3)
-            if data == codecs.encode(_IPS_FOOTER):
-                break
+    def from_records(cls, records):
+        """ Create a patch from an iterable of (offset, bytes) records.
 
-            # Start reading a record.
-            offset = int.from_bytes(data, 'big')
-            size = int.from_bytes(f.read(2), 'big')
+        Records are applied in order, so later ones win where they overlap.
+        """
+        return Patch(ChangeSet.from_records(records))
 
-            # If size is greater than zero, we have a normal record.
-            if size > 0:
-                for i, byte in enumerate(f.read(size)):
-                    changes[offset+i] = byte
+    @classmethod
+    def from_ips(cls, f):
+        """ Load an ips patch file. """
+        return cls.from_records(read_ips(f))
 
-            # If size is instead zero, we have an RLE record.
-            else:
-                rle_size = int.from_bytes(f.read(2), 'big')
-                value = f.read(1)[0]
-                for i in range(rle_size):
-                    changes[offset+i] = value
-        return Patch(changes)
+    @classmethod
+    def from_ips32(cls, f):
+        """ Load an ips32 patch file. """
+        return cls.from_records(read_ips(f))
 
     @classmethod
     def from_ipst(cls, f):
         """ Load an ipst patch file. """
-        # Skip empty or commented lines.
-        f = (line for line in f if not line or not line.startswith("#"))
+        return cls.from_records(read_ipst(f))
 
-        header = next(f).rstrip()
-        if header != _IPS_HEADER:
-            raise PatchFormatError("Header mismatch reading IPST file.")
+    @classmethod
+    def from_bps(cls, f, rom):
+        """ Load a bps patch file.
 
-        changes = {}
-        for line_number, line in enumerate(f, 2):
-            line = line.rstrip()
-            # Check for EOF marker
-            if line == _IPS_FOOTER:
-                break
+        BPS describes the target in terms of the original, so the original
+        ROM (opened in binary mode) is required.
+        """
+        with util.filebuffer(rom) as source:
+            return cls._from_target(source, read_bps(f, source))
 
-            # Normal records have three parts, RLE records have four.
-            parts = line.split(":")
-            if len(parts) == 3:
-                offset, size, data = parts
-                if len(data) != int(size, 16) * 2:
-                    msg = "Data length doesn't match size on line %s."
-                    raise ValueError(msg, line_number)
-                for i, byte in enumerate(bytes.fromhex(data)):
-                    changes[int(offset, 16)+i] = byte
-            elif len(parts) == 4:
-                offset, size, rle_size, value = [int(part, 16)
-                                                 for part in parts]
-                if value > 0xFF:
-                    msg = ("Line {}: RLE value {:02X} "
-                           "won't fit in one byte.")
-                    raise PatchValueError(msg.format(line_number, value))
-                for i in range(rle_size):
-                    changes[offset+i] = value
-            else:
-                msg = "Line {}: IPST format error."
-                raise PatchFormatError(msg.format(line_number))
+    @classmethod
+    def from_ups(cls, f, rom):
+        """ Load a ups patch file against the original ROM."""
+        with util.filebuffer(rom) as source:
+            return cls._from_target(source, read_ups(f, source))
 
+    @classmethod
+    def _from_target(cls, source, target):
+        """ Get the changes that turn source into target.
+
+        Everything past the end of the source is a change, even zeroes, so
+        that applying the patch grows the file to the right size.
+        """
+        if len(target) < len(source):
+            raise PatchValueError("Patch shrinks the file, which romlib "
+                                  "patches can't represent.")
+        changes = ChangeSet()
+        for offset, data in _diffbuffers(source, target, len(source)):
+            changes.write(offset, data)
+        changes.write(len(source), bytes(target[len(source):]))
         return Patch(changes)
 
     @classmethod
@@ -163,121 +1072,196 @@ class Patch(object):
 
         original: The original ROM, opened in binary mode.
         modified: A verion of the ROM containing the desired modifications.
-        """
-        lzip = itertools.zip_longest  # convenience alias
-        iter1 = util.filebytes(original)
-        iter2 = util.filebytes(modified)
-        patch = Patch()
-        for i, (byte1, byte2) in enumerate(lzip(iter1, iter2, fillvalue=0)):
-            if byte2 != byte1:
-                patch.changes[i] = byte2
-        return patch
-
-    def _ips_sanitize_changes(self, bogobyte=None):
-        """ Check for bogoaddr issues and return merged/fixed changes.
-
-        This is a helper function for writing variants of IPS.
-
-        FIXME: We should split up blocks that include both a RLE-appropriate
-        segment and a normal segment. Careful how this interacts with bogoaddr.
-        """
-        # Merge blocks of changes.
-        blocks = self._blockify(self.changes)
 
-        # Deal with bogoaddress issues.
-        try:
-            data = blocks.pop(_IPS_BOGO_ADDRESS)
-            bogo = bogobyte.to_bytes(1, "big")
-            blocks[_IPS_BOGO_ADDRESS-1] = bogo + data
-        except KeyError:
-            # Nothing starts at bogoaddr so we're OK.
-            pass
-        except AttributeError:
-            msg = ("A change started at 0x454F46 (EOF) "
-                   "but a valid bogobyte was not provided.")
-            raise PatchValueError(msg)
-        return blocks
+        Both files are compared a chunk at a time, and identical chunks are
+        skipped without looking at individual bytes. If one file is shorter
+        than the other, it is treated as if it were padded with zeroes.
+        """
+        changes = ChangeSet()
+        with util.filebuffer(original) as old, \
+                util.filebuffer(modified) as new:
+            for offset, data in _diffbuffers(old, new):
+                changes.write(offset, data)
+        return Patch(changes)
 
     def to_ips(self, f, bogobyte=None):
         """ Create an ips patch file."""
-        blocks = self._ips_sanitize_changes(bogobyte)
-        f.write(_IPS_HEADER.encode())
-        for offset, data in sorted(blocks.items()):
-            # Use RLE if we have a long repetition
-            if len(data) > 3 and len(set(data)) == 1:
-                f.write(offset.to_bytes(3, 'big'))
-                f.write(bytes(2))  # Size is zero for RLE
-                f.write(len(data).to_bytes(2, 'big'))
-                f.write(data[0:1])
-            else:
-                f.write(offset.to_bytes(3, 'big'))
-                f.write(len(data).to_bytes(2, 'big'))
-                f.write(data)
-        f.write(_IPS_FOOTER.encode())
+        self._check_limit(_IPS)
+        write_ips(f, self.changes.blocks(), bogobyte)
+
+    def to_ips32(self, f, bogobyte=None):
+        """ Create an ips32 patch file."""
+        self._check_limit(_IPS32)
+        write_ips32(f, self.changes.blocks(), bogobyte)
+
+    def _check_limit(self, fmt):
+        """ Fail before writing anything if changes won't fit in fmt."""
+        if self.changes.end - 1 > fmt.limit:
+            msg = ("Patch changes data up to 0x{:X}, but {} can only address "
+                   "up to 0x{:X}; use a format that supports larger files, "
+                   "such as ips32.")
+            raise PatchValueError(msg.format(self.changes.end - 1, fmt.name,
+                                             fmt.limit))
 
     def to_ipst(self, f, bogobyte=None):
         """ Create an ipst patch file."""
-        blocks = self._ips_sanitize_changes(bogobyte)
-        print(_IPS_HEADER, file=f)
-        for offset, data in sorted(blocks.items()):
-            # Use RLE if we have a long repetition
-            if len(data) > 3 and len(set(data)) == 1:
-                fmt = "{:06X}:{:04X}:{:04X}:{:01X}"
-                print(fmt.format(offset, 0, len(data), data[0]), file=f)
-            else:
-                datastr = ''.join('{:02X}'.format(d) for d in data)
-                fmt = "{:06X}:{:04X}:{}"
-                print(fmt.format(offset, len(data), datastr), file=f)
-        print(_IPS_FOOTER, file=f)
+        write_ipst(f, self.changes.blocks(), bogobyte)
+
+    def to_bps(self, f, rom):
+        """ Create a bps patch file against the original ROM."""
+        with util.filebuffer(rom) as source:
+            write_bps(f, source, self._target(source))
+
+    def to_ups(self, f, rom):
+        """ Create a ups patch file against the original ROM."""
+        with util.filebuffer(rom) as source:
+            write_ups(f, source, self._target(source))
+
+    def _target(self, source):
+        """ Get a copy of source with this patch applied."""
+        target = bytearray(source)
+        for offset, block in self.changes.blocks():
+            if offset > len(target):
+                target.extend(bytes(offset - len(target)))
+            target[offset:offset+len(block)] = block
+        return target
 
     def filter(self, rom):
         """ Remove no-ops from the change list.
 
         This compares the list of changes to the contents of a ROM and
-        filters out any data that is already present."""
-        def getbyte(f, offset):
-            """ Convenience function to get a single byte from a file."""
-            f.seek(offset)
-            return f.read(1)[0]
-
-        self.changes = {offset: value for offset, value in self.changes.items()
-                        if value != getbyte(rom, offset)}
+        filters out any data that is already present. The ROM is mapped rather
+        than read, and each run of changes is compared as a whole.
+        """
+        with util.filebuffer(rom) as orig:
+            blocks = filter_blocks(self.changes.blocks(), orig)
+            self.changes = ChangeSet.from_records(blocks)
 
     def apply(self, f):
         """ Apply a patch to a file object.
 
         The file should be opened with mode "r+b".
         """
-        for offset, block in self._blockify(self.changes).items():
-            f.seek(offset)
-            f.write(block)
+        apply_blocks(list(self.changes.blocks()), f)
 
-    def save(self, outfile, ptype=None):
+    def save(self, outfile, ptype=None, rom=None):
         """ Save a patch to a file.
 
         This detects the type of patch from the filename extension. You can
-        override detection by supplying ptype.
+        override detection by supplying ptype. Some formats (bps, ups) are
+        relative to the original ROM, and must be given its filename as rom.
         """
         if ptype is None:
-            # Take the extension of the filename and strip the leading dot.
-            ptype = os.path.splitext(outfile)[-1][1:]
+            ptype = _ptype(outfile)
         pfunc = getattr(self, "to_"+ptype)
         mode = 'wt' if ptype.endswith('t') else 'wb'
-        with open(outfile, mode) as f:
-            pfunc(f)
+        with _creating(outfile, mode) as f:
+            if ptype in _SOURCE_TYPES:
+                with _open_source(rom, ptype) as romfile:
+                    pfunc(f, romfile)
+            else:
+                pfunc(f)
 
     @classmethod
-    def load(cls, patchfile, ptype=None):
+    def load(cls, patchfile, ptype=None, rom=None):
         """ Load a patch given a filename.
 
         This detects the type of patch from the filename extension. You can
-        override detection by supplying ptype.
+        override detection by supplying ptype. Some formats (bps, ups) are
+        relative to the original ROM, and must be given its filename as rom.
         """
         if ptype is None:
-            # Take the extension of the filename and strip the leading dot.
-            ptype = os.path.splitext(patchfile)[-1][1:]
+            ptype = _ptype(patchfile)
         pfunc = getattr(cls, "from_"+ptype)
         mode = 'rt' if ptype.endswith('t') else 'rb'
         with open(patchfile, mode) as f:
-            patch = pfunc(f)
-        return patch
+            if ptype in _SOURCE_TYPES:
+                with _open_source(rom, ptype) as romfile:
+                    return pfunc(f, romfile)
+            return pfunc(f)
+
+
+def _ptype(filename):
+    """ Get a patch type from a filename's extension."""
+    return os.path.splitext(filename)[-1][1:]
+
+
+def needs_rom(filename, ptype=None):
+    """ Check whether a patch file can only be used with the original ROM."""
+    return (ptype or _ptype(filename)) in _SOURCE_TYPES
+
+
+def _open_source(rom, ptype):
+    """ Open the original ROM for a format that needs it."""
+    if rom is None:
+        msg = "{} patches need the original ROM to be supplied."
+        raise PatchValueError(msg.format(ptype.upper()))
+    return open(rom, 'rb')
+
+
+def convert(infile, outfile, intype=None, outtype=None, rom=None):
+    """ Convert a patch file from one format to another.
+
+    Records are streamed from input to output one at a time, so memory use
+    doesn't depend on the size of the patch. Records are not merged or
+    sorted, so overlapping records stay overlapping (and still apply in the
+    same order).
+
+    Types are detected from the filename extensions unless supplied. Formats
+    that are relative to the original ROM can't be streamed; converting to or
+    from them loads the whole patch, and needs the ROM's filename as rom.
+    """
+    intype = intype or _ptype(infile)
+    outtype = outtype or _ptype(outfile)
+    if intype in _SOURCE_TYPES or outtype in _SOURCE_TYPES:
+        patch = Patch.load(infile, intype, rom)
+        patch.save(outfile, outtype, rom)
+        return
+    try:
+        reader = _readers[intype]
+        writer = _writers[outtype]
+    except KeyError as err:
+        raise ValueError("Unsupported patch type: {}".format(err.args[0]))
+    inmode = 'rt' if intype.endswith('t') else 'rb'
+    outmode = 'wt' if outtype.endswith('t') else 'wb'
+    with open(infile, inmode) as fin, _creating(outfile, outmode) as fout:
+        writer(fout, reader(fin))
+
+
+def write_blocks(outfile, blocks, ptype=None, rom=None):
+    """ Write a stream of sorted (offset, bytes) blocks to a patch file.
+
+    Formats that can be streamed are written as the blocks arrive. Formats
+    that need the original ROM are collected into a Patch and saved instead.
+    """
+    ptype = ptype or _ptype(outfile)
+    if ptype in _SOURCE_TYPES:
+        Patch.from_records(blocks).save(outfile, ptype, rom)
+        return
+    try:
+        writer = _writers[ptype]
+    except KeyError:
+        raise ValueError("Unsupported patch type: {}".format(ptype))
+    mode = 'wt' if ptype.endswith('t') else 'wb'
+    with _creating(outfile, mode) as f:
+        writer(f, blocks)
+
+
+@contextlib.contextmanager
+def _creating(outfile, mode):
+    """ Open a patch file for writing, removing it again if writing fails.
+
+    Problems like changes past the end of the format's address space may
+    only turn up partway through, and a partial patch is worse than none.
+    """
+    with open(outfile, mode) as f:
+        try:
+            yield f
+        except Exception:
+            f.close()
+            os.remove(outfile)
+            raise
+
+
+_readers = {'ips': read_ips, 'ips32': read_ips, 'ipst': read_ipst}
+_writers = {'ips': write_ips, 'ips32': write_ips32, 'ipst': write_ipst}
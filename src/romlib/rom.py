@@ -25,6 +25,7 @@
 # enough to be too big for memory probably has a real filesystem.
 
 import io
+import hashlib
 import string
 import logging
 import math
@@ -32,15 +33,23 @@ from abc import ABCMeta
 from os.path import dirname, basename, realpath
 from os.path import join as pathjoin
 
-from bitstring import BitStream, ConstBitStream
+from bitstring import BitStream
 
 from . import util
 from . import struct
+from . import patch
 
 
 log = logging.getLogger(__name__)
 headers = util.load_builtins('headers', '.tsv', struct.load)
 
+# Rom types by name, in detection order. Types with a cheap magic-number
+# check should be defined first.
+_romtypes = {}
+
+# How many leading bytes of the file are passed to detectors.
+MAGIC_SIZE = 16
+
 class RomFormatError(Exception):
     pass
 
@@ -50,73 +59,126 @@ class HeaderError(RomFormatError):
 
 
 class Rom:
-    def __init__(self, romfile, rommap=None):
-        self.validate(romfile)
+    """ Base class for rom images.
+
+    Subclasses register themselves by defining `romtype`, and must provide a
+    `detect` classmethod that identifies their header from the file size and
+    the first few bytes of the file. `offset` is the size of any copier or
+    emulator header preceding the rom data proper.
+
+    The file is memory-mapped rather than read. `orig` is a read-only view of
+    the whole file and `data` a view of the rom proper, without any header;
+    neither copies anything. Writes go to `changes`, a sparse overlay that
+    starts out empty, and `read` sees them on top of the original data.
+    Offsets for `read`, `write` and `changes` are relative to `data`.
+    """
+    romtype = None
+    offset = 0
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if cls.romtype is not None:
+            _romtypes[cls.romtype] = cls
+
+    def __init__(self, romfile, rommap=None, header=None):
+        if header is None:
+            header = self.read_header(romfile)
+        self.header = header
         self.map = rommap
-        self.orig = ConstBitStream(romfile)
-        self.data = BitStream(self.orig)
+        self.changes = patch.ChangeSet()
+        self._buf = util.mapfile(romfile)
+        self.orig = memoryview(self._buf)
+        self.data = self.orig[self.offset:]
+
+    def __len__(self):
+        return len(self.data)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def read(self, offset, size):
+        """ Read bytes from the rom, including any changes written."""
+        out = bytearray(self.data[offset:offset+size])
+        for start, block in self.changes.blocks(offset, offset+len(out)):
+            out[start-offset:start-offset+len(block)] = block
+        return bytes(out)
+
+    def write(self, offset, data):
+        """ Write bytes to the rom's change overlay."""
+        if offset < 0 or offset + len(data) > len(self.data):
+            raise IndexError("Write outside rom: {:X}".format(offset))
+        self.changes.write(offset, data)
+
+    def close(self):
+        """ Release the rom's file mapping, if it has one."""
+        self.data.release()
+        self.orig.release()
+        if hasattr(self._buf, 'close'):
+            self._buf.close()
 
     @classmethod
-    def make(cls, romfile):
-        log.debug("Autodetecting rom type")
-        for romcls in cls.__subclasses__():
-            try:
-                log.debug("Trying: %s", romcls.romtype)
-                if romcls.validate(romfile):
-                    return romcls(romfile)
-            except RomFormatError:
-                pass
-        else:
-            raise RomFormatError("Input does not match any known ROM format")
+    def detect(cls, romfile, size, magic):
+        """ Read and return the rom header, or raise RomFormatError.
+
+        `size` is the size of the file and `magic` its first `MAGIC_SIZE`
+        bytes; implementations should only read anything else if those
+        don't rule the file out.
+        """
+        raise NotImplementedError
+
+    @classmethod
+    def read_header(cls, romfile):
+        size, magic = _sniff(romfile)
+        return cls.detect(romfile, size, magic)
+
+    @classmethod
+    def validate(cls, romfile):
+        cls.read_header(romfile)
+        return True
+
+    @classmethod
+    def make(cls, romfile, rommap=None):
+        romcls, header = detect(romfile)
+        return romcls(romfile, rommap, header)
 
 
 class INESRom(Rom):
     romtype = 'ines'
     hdr_ident = b"NES\x1a"
-
-    def __init__(self, romfile, rommap=None):
-        super().__init__(romfile, rommap)
-        bs_head = self.orig[:16*8]
-        self.header = headers[self.romtype](bs_head)
-        self.data = self.orig[16*8:]
+    offset = 16
 
     @classmethod
-    def validate(cls, romfile):
-        romfile.seek(0)
-        ident = romfile.read(4)
+    def detect(cls, romfile, size, magic):
+        ident = magic[:len(cls.hdr_ident)]
         if ident != cls.hdr_ident:
             msg = "Bad ines header ident ({} != {})"
             raise HeaderError(msg.format(ident, cls.hdr_ident))
-        return True
+        if size < cls.offset:
+            raise HeaderError("File too small for an ines header")
+        return headers[cls.romtype](BitStream(bytes=magic[:cls.offset]))
 
 
 class SNESRom(Rom):
     romtype = 'snes'
     sz_smc = 0x200
+    sz_header = 64
     ofs_lorom = 0x7FB0
     ofs_hirom = 0xFFB0
 
-    def __init__(self, romfile, rommap=None):
-        super().__init__(romfile, rommap)
-        self.smc = self._load_smc(romfile)
-        self.header = self._load_header(romfile)
-        self.data = BitStream(self.orig[len(self.smc*8):])
+    def __init__(self, romfile, rommap=None, header=None):
+        self.offset = self._smcsize(util.filesize(romfile))
+        super().__init__(romfile, rommap, header)
+        self.smc = bytes(self.orig[:self.offset])
 
     @classmethod
-    def validate(cls, romfile):
-        try:
-            return bool(cls._load_header(romfile))
-        except HeaderError:
-            return False
-
-    @classmethod
-    def _load_smc(cls, romfile):
-        sz_file = util.filesize(romfile)
-        sz_smc = sz_file % 1024
+    def _smcsize(cls, size):
+        sz_smc = size % 1024
         if sz_smc not in [0, cls.sz_smc]:
             raise HeaderError("Bad rom file size or corrupt SMC header")
-        romfile.seek(0)
-        return romfile.read(sz_smc)
+        return sz_smc
 
     @classmethod
     def checksum(cls, romdata):
@@ -125,22 +187,21 @@ class SNESRom(Rom):
             raise NotImplementedError(msg.format(len(romdata)))
         return sum(romdata) % 0xFFFF
 
-
     @classmethod
-    def _load_header(cls, romfile):
-        smc = cls._load_smc(romfile)
-        romfile.seek(len(smc))
-        data = romfile.read()
+    def detect(cls, romfile, size, magic):
+        sz_smc = cls._smcsize(size)
+        datasize = size - sz_smc
 
         for offset in [cls.ofs_hirom, cls.ofs_lorom]:
-            if offset > len(data):
+            if offset + cls.sz_header > datasize:
                 # Happens for at least one Game Genie rom -- it's lorom and not
                 # physically large enough to be hirom
                 continue
-            bs_head = BitStream(bytes=data[offset:offset+64])
+            romfile.seek(sz_smc + offset)
+            bs_head = BitStream(bytes=romfile.read(cls.sz_header))
             try:
                 header = headers[cls.romtype](bs_head)
-                cls._validate_header(offset, len(data), header)
+                cls._validate_header(offset, datasize, header)
                 return header
             except (UnicodeDecodeError, HeaderError) as e:
                 # The unicode one gets thrown when the name string isn't valid.
@@ -161,7 +222,42 @@ class SNESRom(Rom):
 
         return True
 
+
+def _sniff(romfile):
+    """ Get the size and leading bytes of a rom file."""
+    size = util.filesize(romfile)
+    romfile.seek(0)
+    return size, romfile.read(MAGIC_SIZE)
+
+
+def detect(romfile):
+    """ Detect the type of a rom from its header.
+
+    Returns a (romcls, header) tuple. Only the file size and the header
+    windows of each candidate type are read, never the whole file.
+    """
+    log.debug("Autodetecting rom type")
+    size, magic = _sniff(romfile)
+    for romcls in _romtypes.values():
+        try:
+            return romcls, romcls.detect(romfile, size, magic)
+        except RomFormatError as e:
+            log.debug("Not %s: %s", romcls.romtype, e)
+    raise RomFormatError("Input does not match any known ROM format")
+
+
+def fingerprint(romfile):
+    """ Identify a rom by its header alone.
+
+    Returns a string of the form 'romtype:digest', where digest is derived
+    from the parsed header contents. Unlike a hash of the whole file, this
+    doesn't depend on copier headers or on the rest of the image.
+    """
+    romcls, header = detect(romfile)
+    contents = repr(sorted(header.dump().items())).encode()
+    return "{}:{}".format(romcls.romtype, hashlib.sha1(contents).hexdigest())
+
+
 def identify(romfile):
-    # Requires reading the whole rom to determine its type. There must be a
-    # better way to do this.
-    return Rom.make(romfile).romtype
+    romcls, header = detect(romfile)
+    return romcls.romtype
@@ -6,27 +6,29 @@ I would be *really* happy if I could implement this using python's built in
 codec capabilities.
 """
 
-import re
+import string
 import codecs
 import logging
 import functools
 
-from pprint import pprint
-
-from patricia import trie
-
 
 log = logging.getLogger(__name__)
 
+# How bytes not in a table are rendered when decoding.
+_RAW = ["[${:02X}]".format(byte) for byte in range(256)]
+_HEXDIGITS = set(string.hexdigits)
+# Returned by _match when the data ends partway through a possible code.
+_MORE = object()
+
 
 class TextTable(object):
     """ A ROM text table, used for decoding and encoding text strings."""
     def __init__(self, name, f):
         self.id = None  # pylint: disable=invalid-name
         self.name = name
-        self.enc = trie()
-        self.dec = trie()
         self.eos = []
+        self._codes = {}
+        self._switches = {}
 
         # Skip blank lines when reading.
         lines = [line for line
@@ -41,79 +43,458 @@ class TextTable(object):
                 self.id = line
                 continue
             if prefix == "!":
-                msg = "Table switching not yet implemented."
-                raise NotImplementedError(msg)
+                # Table switch: !code=TableID,NumberOfTableMatches
+                code, target = line.split("=", 1)
+                tableid, count = target.rsplit(",", 1)
+                self._switches[bytes.fromhex(code)] = tableid, int(count)
+                continue
 
             code, text = line.split("=", 1)
             codeseq = bytes.fromhex(code)
-            self.enc[text] = codeseq
-            self.dec[codeseq] = text
+            self._codes[codeseq] = text
             if prefix == "/":
                 self.eos.append(codeseq)
 
-    def encode(self, string):
-        """ Encode a string into a series of bytes."""
+        self._root = self._compile_decoder()
+        self._encroot = self._compile_encoder()
 
-        # FIXME: Needs to append EOS if called for.
-        codeseq = []
-        i = 0
-        raw = r"^\[\$[a-fA-F0-9]{2}\]"
-        while i < len(string):
-            if re.match(raw, string[i:]):
-                # Oops, raw byte listing.
-                code = int(string[i+2:i+4], 16)
-                codeseq.append(code)
-                i += 5
+    def _compile_decoder(self):
+        """ Compile the decoding table into a byte-indexed state machine.
+
+        Returns a list indexed by first byte. Each entry is None if no code
+        starts with that byte, or a node tuple of (text, children, eos,
+        switch): the text for the code ending here (None if this is only a
+        prefix of longer codes), a dictionary mapping the next byte to
+        another node (None if there are no longer codes), whether this is an
+        EOS code, and the (table id, count) to switch to for a table switch
+        code. Switch codes have empty text.
+        """
+        root = {}
+        eos = set(self.eos)
+        entries = [(codeseq, text, None)
+                   for codeseq, text in self._codes.items()]
+        entries.extend((codeseq, "", switch)
+                       for codeseq, switch in self._switches.items())
+        for codeseq, text, switch in entries:
+            nodes = root
+            for i, byte in enumerate(codeseq):
+                node = nodes.get(byte, (None, None, False, None))
+                if i == len(codeseq) - 1:
+                    node = (text, node[1], codeseq in eos, switch)
+                elif node[1] is None:
+                    node = (node[0], {}, node[2], node[3])
+                nodes[byte] = node
+                nodes = node[1]
+        return [root.get(byte) for byte in range(256)]
+
+    def _compile_encoder(self):
+        """ Compile the encoding table into a character-indexed trie.
+
+        Nodes are (code, children) tuples, as for the decoder, keyed by
+        character rather than byte. Entries with no text can't be encoded
+        and are left out.
+        """
+        root = {}
+        for codeseq, text in self._codes.items():
+            nodes = root
+            for i, char in enumerate(text):
+                node = nodes.get(char, (None, None))
+                if i == len(text) - 1:
+                    node = (codeseq, node[1])
+                elif node[1] is None:
+                    node = (node[0], {})
+                nodes[char] = node
+                nodes = node[1]
+        return root
+
+    def _candidates(self, string, i):
+        """ Get the ways string[i:] could start, longest first.
+
+        Returns a list of (code, end) pairs, where string[i:end] encodes to
+        code, and whether more text after the end of the string could have
+        allowed a longer match. A raw byte escape at i is the only candidate
+        when present.
+        """
+        more = False
+        if string[i] == "[":
+            escape = string[i:i+5]
+            if len(escape) == 5:
+                if (escape[1] == "$" and escape[4] == "]"
+                        and all(c in _HEXDIGITS for c in escape[2:4])):
+                    # Oops, raw byte listing.
+                    return [(bytes([int(escape[2:4], 16)]), i + 5)], False
             else:
-                match, code = self.enc.item(string[i:])
-                codeseq.extend(code)
-                i += len(match)
-        return bytes(codeseq), len(string)
+                # Could be the start of one.
+                more = ("[$".startswith(escape[:2])
+                        and all(c in _HEXDIGITS for c in escape[2:4]))
+        found = []
+        node = self._encroot.get(string[i])
+        j = i + 1
+        while node is not None:
+            code, children = node
+            if code is not None:
+                found.append((code, j))
+            if children is None:
+                break
+            if j >= len(string):
+                more = True
+                break
+            node = children.get(string[j])
+            j += 1
+        found.reverse()
+        return found, more
+
+    def encode(self, string, add_eos=False, optimal=False):
+        """ Encode a string into a series of bytes.
+
+        Raw byte escapes like [$0A] are encoded as-is; everything else is
+        matched against the table. Normally that's longest match first,
+        which is fast and usually good. If optimal is true, the shortest
+        possible encoding is found instead; that can be shorter for tables
+        with multi-character (DTE/MTE) entries.
+
+        If add_eos is true and the table has an EOS code, it's appended
+        unless the string already ends with one.
+        """
+        out, size = self._encode(string, optimal)
+        if add_eos and not self._endswith_eos(out):
+            out += self.eos[0]
+        return out, size
+
+    def _endswith_eos(self, data):
+        """ Check whether data ends in an EOS code; True if there are none."""
+        return not self.eos or any(data.endswith(code) for code in self.eos)
+
+    def _encode(self, string, optimal=False, final=True):
+        """ Encode as much of a string as possible.
+
+        Returns the encoded bytes and how many characters were used. Unless
+        final is true, text at the end that might be part of a longer match
+        is left for next time.
+        """
+        if optimal:
+            # The best encoding of the start of a string can depend on
+            # anything after it, so there's no encoding it piecemeal.
+            if not final:
+                return b"", 0
+            return b"".join(self._encode_optimal(string)), len(string)
+        codes = []
+        size = len(string)
+        i = 0
+        while i < size:
+            candidates, more = self._candidates(string, i)
+            if more and not final:
+                break
+            if not candidates:
+                raise UnicodeEncodeError(self.name, string, i, i + 1,
+                                         "not in text table")
+            code, i = candidates[0]
+            codes.append(code)
+        return b"".join(codes), i
+
+    def _encode_optimal(self, string):
+        """ Find the shortest encoding of a string, as a list of codes.
+
+        This is a shortest-path search over string positions, working
+        backwards: cost[i] is the fewest bytes that can encode string[i:].
+        It takes time proportional to the string length times the number
+        of table entries that can match at each position. Ties go to the
+        longer match, as with greedy encoding.
+        """
+        size = len(string)
+        cost = [0] + [None] * size
+        choice = [None] * size
+        # Index from the end, so cost[size-i] is the cost of string[i:].
+        for i in range(size - 1, -1, -1):
+            for code, end in self._candidates(string, i)[0]:
+                rest = cost[size-end]
+                if rest is None:
+                    continue
+                if cost[size-i] is None or len(code) + rest < cost[size-i]:
+                    cost[size-i] = len(code) + rest
+                    choice[i] = code, end
+        if cost[size] is None:
+            i = next(i for i in range(size)
+                     if not self._candidates(string, i)[0])
+            raise UnicodeEncodeError(self.name, string, i, i + 1,
+                                     "not in text table")
+        codes = []
+        i = 0
+        while i < size:
+            code, i = choice[i]
+            codes.append(code)
+        return codes
 
     def decode(self, data, include_eos=True, stop_on_eos=True):
         """ Decode a series of bytes.
 
-        Any unrecognized bytes will be rendered as hex codes.
+        Any unrecognized bytes will be rendered as hex codes. Codes are
+        matched longest-first by walking the compiled table one byte at a
+        time, so nothing is sliced or copied along the way.
+        """
+        return self._decode(data, include_eos, stop_on_eos)
+
+    def _decode(self, data, include_eos=True, stop_on_eos=True, final=True,
+                state=None):
+        """ Decode as much of a series of bytes as possible.
+
+        Returns the decoded text and how many bytes were used. Unless final
+        is true, bytes at the end that might be part of a longer code are
+        left for next time.
+
+        For tables with switch codes, state is the list of tables switched
+        into, which is updated in place so decoding can pick up where it
+        left off. It's ignored otherwise.
         """
-        text = ""
+        if self._switches:
+            if state is None:
+                state = []
+            return self._decode_switching(data, include_eos, stop_on_eos,
+                                          final, state)
+        root = self._root
+        size = len(data)
+        parts = []
         i = 0
-        while i < len(data):
-            raw = "[${:02X}]".format(data[i])
-            match, string = self.dec.item(data[i:], default=raw)
+        while i < size:
+            node = root[data[i]]
+            end = i + 1
+            match = None
+            if node is not None:
+                if node[0] is not None:
+                    match = node, end
+                children = node[1]
+                j = end
+                while children is not None:
+                    if j == size:
+                        break
+                    node = children.get(data[j])
+                    if node is None:
+                        break
+                    j += 1
+                    if node[0] is not None:
+                        match = node, j
+                    children = node[1]
+                if children is not None and j == size and not final:
+                    break
             if match is None:
-                match = data[i:i+1]
-            if include_eos or (match not in self.eos):
-                text += string
-            if stop_on_eos and (match in self.eos):
-                i += len(match)
+                parts.append(_RAW[data[i]])
+                i = end
+                continue
+            (string, children, eos, switch), i = match
+            if include_eos or not eos:
+                parts.append(string)
+            if stop_on_eos and eos:
+                break
+        return "".join(parts), i
+
+    def _decode_switching(self, data, include_eos, stop_on_eos, final, stack):
+        """ Decode a series of bytes, following table switch codes.
+
+        This is kept apart from _decode so tables without switch codes
+        don't pay for it. Each entry on the stack is a [table, count,
+        remaining] list for a table switched into; when it's empty, this
+        table is active. A count above zero means return to the previous
+        table after that many matches, 0 means return after the first byte
+        that doesn't match, and -1 means stay until switched away from.
+        Bytes that don't match are retried in the previous table, if any,
+        unless the count is -1. EOS codes end the string, so they return to
+        this table.
+        """
+        size = len(data)
+        parts = []
+        i = 0
+        while i < size:
+            if stack:
+                table, count, remaining = stack[-1]
+            else:
+                table, count = self, None
+            match = _match(table._root, data, i, final)
+            if match is _MORE:
                 break
-            i += len(match)
-        return text, i
+            if match is None:
+                if stack and count != -1:
+                    stack.pop()
+                    continue
+                parts.append(_RAW[data[i]])
+                i += 1
+                continue
+            (string, children, eos, switch), i = match
+            if switch is not None:
+                tableid, count = switch
+                stack.append([self._table(tableid), count, count])
+                continue
+            if include_eos or not eos:
+                parts.append(string)
+            if eos:
+                stack.clear()
+                if stop_on_eos:
+                    break
+            elif count is not None and count > 0:
+                if remaining == 1:
+                    stack.pop()
+                else:
+                    stack[-1][2] = remaining - 1
+        return "".join(parts), i
+
+    def _table(self, tableid):
+        """ Look up a table to switch to by ID or name."""
+        if tableid in (self.id, self.name):
+            return self
+        try:
+            return tt_tables[tableid]
+        except KeyError:
+            msg = "{}: unknown table '{}' in switch code"
+            raise LookupError(msg.format(self.name, tableid))
+
+
+def _match(root, data, i, final=True):
+    """ Find the longest code in a compiled table at data[i].
+
+    Returns a (node, end) pair, None if nothing matches, or _MORE if the data
+    ends partway through a possible code and final is false.
+    """
+    size = len(data)
+    node = root[data[i]]
+    j = i + 1
+    match = None
+    while node is not None:
+        if node[0] is not None:
+            match = node, j
+        children = node[1]
+        if children is None:
+            break
+        if j == size:
+            if not final:
+                return _MORE
+            break
+        node = children.get(data[j])
+        j += 1
+    return match
+
+# Incremental and stream codecs. Text in a stream is usually a whole bank of
+# strings, so these keep going past EOS codes instead of stopping at the
+# first one. add_tt makes a subclass of each for every table and variant.
 
+class IncrementalDecoder(codecs.BufferedIncrementalDecoder):
+    """ Decode text a chunk at a time.
+
+    Codes split across chunks are held over until the next chunk arrives.
+    """
+    table = None
+    include_eos = True
+
+    def __init__(self, errors='strict'):
+        super().__init__(errors)
+        self._tables = []
+
+    def _buffer_decode(self, data, errors, final):
+        return self.table._decode(data, self.include_eos, False, final,
+                                  self._tables)
+
+    def reset(self):
+        super().reset()
+        self._tables = []
+
+
+class IncrementalEncoder(codecs.BufferedIncrementalEncoder):
+    """ Encode text a chunk at a time.
+
+    Greedy encoding holds over only text that might be the start of a longer
+    match. Optimal encoding holds over everything until the final chunk.
+    """
+    table = None
+    add_eos = False
+    optimal = False
+
+    def __init__(self, errors='strict'):
+        super().__init__(errors)
+        self._eos = False
+
+    def _buffer_encode(self, string, errors, final):
+        out, size = self.table._encode(string, self.optimal, final)
+        if out:
+            self._eos = self.table._endswith_eos(out)
+        if final and self.add_eos and not self._eos:
+            out += self.table.eos[0]
+            self._eos = True
+        return out, size
+
+    def reset(self):
+        super().reset()
+        self._eos = False
+
+
+class StreamReader(codecs.StreamReader):
+    """ Read text from a byte stream."""
+    table = None
+    include_eos = True
+
+    def __init__(self, stream, errors='strict'):
+        super().__init__(stream, errors)
+        self._tables = []
+
+    def decode(self, input, errors='strict'):
+        # StreamReader.read passes back whatever we didn't use last time in
+        # bytebuffer, plus whatever it read since. If it didn't read anything
+        # the stream is done, and the leftovers have to be decoded as-is.
+        final = len(input) == len(self.bytebuffer)
+        return self.table._decode(input, self.include_eos, False, final,
+                                  self._tables)
+
+    def reset(self):
+        super().reset()
+        self._tables = []
 
 tt_codecs = {}
+# Tables by name and ID, for switch codes to refer to.
+tt_tables = {}
 def add_tt(name, f):
     tt = TextTable(name, f)
-    # Arguments to pass to tt.decode for each codec.
-    args = {"":       (True, True),
-            "-std":   (True, True),
-            "-clean": (False, True),
-            "-raw":   (True, False)}
+    tt_tables[name] = tt
+    if tt.id is not None:
+        tt_tables[tt.id] = tt
+    # Arguments to pass to tt.decode and tt.encode for each codec. The
+    # -clean variant strips EOS codes when decoding, so it has to put them
+    # back when encoding. The -min variant is -std, but encodes to as few
+    # bytes as possible.
+    args = {"":       (True, True, False, False),
+            "-std":   (True, True, False, False),
+            "-clean": (False, True, True, False),
+            "-raw":   (True, False, False, False),
+            "-min":   (True, True, False, True)}
 
     for subcodec, subargs in args.items():
         # There has got to be a cleaner way to do this...
         decoder = functools.partial(tt.decode,
                                     include_eos=subargs[0],
                                     stop_on_eos=subargs[1])
+        encoder = functools.partial(tt.encode,
+                                    add_eos=subargs[2],
+                                    optimal=subargs[3])
+        streamargs = {"table": tt,
+                      "include_eos": subargs[0],
+                      "add_eos": subargs[2],
+                      "optimal": subargs[3]}
 
         codec = codecs.CodecInfo(
                 name=name+subcodec,
-                encode=tt.encode,
-                decode=decoder
+                encode=encoder,
+                decode=decoder,
+                incrementalencoder=type("IncrementalEncoder",
+                                        (IncrementalEncoder,), streamargs),
+                incrementaldecoder=type("IncrementalDecoder",
+                                        (IncrementalDecoder,), streamargs),
+                streamreader=type("StreamReader",
+                                  (StreamReader,), streamargs)
                 )
-        tt_codecs[name+subcodec] = codec
+        tt_codecs[_normalize(name+subcodec)] = codec
+
+def _normalize(name):
+    # Codec lookups are lowercased and have spaces and hyphens turned into
+    # underscores before they get to us.
+    return name.lower().replace(" ", "_").replace("-", "_")
 
 def get_tt_codec(name):
-    return tt_codecs.get(name, None)
+    return tt_codecs.get(_normalize(name), None)
 
 codecs.register(get_tt_codec)
@@ -1,10 +1,17 @@
 """ Various utility functions used in romlib."""
 
+import io
 import csv
+import mmap
 import contextlib
 import logging
 import os
-from collections import OrderedDict
+import zlib
+import hashlib
+import math
+import re
+import itertools
+from collections import OrderedDict, Counter, deque
 from os.path import dirname, realpath
 from os.path import join as pathjoin
 
@@ -241,6 +248,37 @@ def filebytes(f):
         byte = f.read(1)
 
 
+def mapfile(f):
+    """ Get a read-only buffer over the entire contents of a binary file.
+
+    Real files are memory-mapped, so only the parts that actually get touched
+    are read from disk. Anything that can't be mapped (BytesIO objects, pipes,
+    empty files) is read into memory instead. Either way the result supports
+    len(), slicing and the buffer protocol. The caller is responsible for
+    closing mmaps; see filebuffer for a context manager that does so.
+    """
+    try:
+        f.flush()  # The mapping sees the file on disk, not python's buffer.
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (AttributeError, io.UnsupportedOperation, ValueError, OSError):
+        f.seek(0)
+        return f.read()
+
+
+@contextlib.contextmanager
+def filebuffer(f):
+    """ Context manager version of mapfile.
+
+    Slices of the buffer are bytes objects.
+    """
+    buf = mapfile(f)
+    if not isinstance(buf, mmap.mmap):
+        yield buf
+        return
+    with buf:
+        yield buf
+
+
 def bit_offset(source):
     """ Find the current read position of *source*, in bits.
 
@@ -352,3 +390,170 @@ def filesize(f):
     size = f.tell()
     f.seek(pos)
     return size
+
+
+def filehashes(f, chunksize=2**20):
+    """ Get the sha1, md5 and crc32 of a binary file in a single pass.
+
+    The file is read in fixed-size chunks from the start, so this works on
+    images much larger than memory. Returns a dictionary of lowercase hex
+    digests keyed by algorithm name.
+    """
+    sha1 = hashlib.sha1()
+    md5 = hashlib.md5()
+    crc = 0
+    buf = bytearray(chunksize)
+    view = memoryview(buf)
+    f.seek(0)
+    while True:
+        size = f.readinto(buf)
+        if not size:
+            break
+        chunk = view[:size]
+        sha1.update(chunk)
+        md5.update(chunk)
+        crc = zlib.crc32(chunk, crc)
+    return {'sha1': sha1.hexdigest(),
+            'md5': md5.hexdigest(),
+            'crc32': "{:08x}".format(crc)}
+
+
+_ZEROS = re.compile(rb"\x00*")
+
+
+def findruns(data, minlen=1, values=None):
+    """ Find runs of a repeated byte in a buffer.
+
+    Yields (offset, length, byte) for each maximal run at least minlen bytes
+    long, in order of offset. If values is given, only runs of those byte
+    values are reported. The work is done with bulk bytes operations rather
+    than per-byte Python code, so this is fast even on large images.
+    """
+    if minlen < 2:
+        # Every byte is part of some run, so this reports everything in
+        # between the longer runs byte by byte. Output is about as large as
+        # the input, so don't expect it to be quick on large images.
+        yield from _findsingles(data, values)
+        return
+
+    # Any run at least minlen long covers two consecutive multiples of step.
+    # So: take every step'th byte, compare each sample with the next by
+    # xoring the sample against itself shifted by one, and look for zeros.
+    # Only the areas around matching samples need to be searched properly.
+    step = minlen // 2
+    with memoryview(data) as view:
+        sample = bytes(view[::step])
+    size = len(sample) - 1
+    if size < 1:
+        return
+    diff = (int.from_bytes(sample[:-1], 'little')
+            ^ int.from_bytes(sample[1:], 'little')).to_bytes(size, 'little')
+    patterns = {}
+    i = diff.find(0)
+    while i != -1:
+        # sample[i:end+1] are all the same byte, and the samples on either
+        # side aren't, which bounds any run that includes them.
+        end = _ZEROS.match(diff, i).end()
+        byte = sample[i]
+        if values is None or byte in values:
+            lo = (i - 1) * step + 1 if i else 0
+            hi = min(len(data), (end + 1) * step)
+            if byte not in patterns:
+                patterns[byte] = re.compile(
+                        rb"%s{%d,}" % (re.escape(bytes([byte])), minlen))
+            for match in patterns[byte].finditer(data, lo, hi):
+                start, stop = match.span()
+                yield start, stop - start, byte
+        i = diff.find(0, end)
+
+
+def _findsingles(data, values=None):
+    """ findruns() for minlen 1: runs of two or more, plus all the gaps."""
+    if values:
+        pattern = re.compile(b"[%s]" % b"".join(re.escape(bytes([value]))
+                                                  for value in values))
+    pos = 0
+    for start, length, byte in itertools.chain(findruns(data, 2, values),
+                                                [(len(data), 0, None)]):
+        if values is None:
+            for i in range(pos, start):
+                yield i, 1, data[i]
+        elif values:
+            for match in pattern.finditer(data, pos, start):
+                i = match.start()
+                yield i, 1, data[i]
+        if length:
+            yield start, length, byte
+        pos = start + length
+
+
+# Byte classes reported by profile(), as (name, bytes) pairs. Anything not
+# in one of these counts as "other".
+BYTE_CLASSES = [("zero", b"\x00"),
+                ("ff", b"\xff"),
+                ("ascii", bytes(range(0x20, 0x7F)))]
+
+
+def profile(f, window=1024, step=256):
+    """ Compute an entropy and byte-class profile of a binary file.
+
+    Yields (offset, size, entropy, classes) for windows of `window` bytes
+    starting every `step` bytes. Entropy is Shannon entropy in bits per byte,
+    from 0 to 8; classes is a dictionary of the fraction of the window's
+    bytes falling in each of BYTE_CLASSES, plus "other". Windows near the
+    end of the file are truncated rather than dropped, so every step gets a
+    row.
+
+    The file is read once, one step at a time. Histograms are kept per step
+    and the window's histogram is a running sum of them, so memory use
+    depends on the window size, not the file size.
+    """
+    if step <= 0 or window % step:
+        raise ValueError("window must be a multiple of step")
+    nsteps = window // step
+    # Entropy is log2(n) - sum(c*log2(c))/n over counts c; precompute the
+    # c*log2(c) terms.
+    clog = [0.0] + [c * math.log2(c) for c in range(1, window + 1)]
+    classtable = bytearray([len(BYTE_CLASSES)] * 256)
+    for i, (name, members) in enumerate(BYTE_CLASSES):
+        for byte in members:
+            classtable[byte] = i
+    classnames = [name for name, members in BYTE_CLASSES] + ["other"]
+
+    chunks = deque()
+    counts = [0] * 256
+    total = 0    # Bytes in the window.
+    clogsum = 0  # Sum of clog over the window's histogram.
+    classcounts = [0] * len(classnames)
+    offset = 0
+    f.seek(0)
+    while True:
+        chunk = f.read(step)
+        if chunk:
+            hist = Counter(chunk)
+            for byte, n in hist.items():
+                c = counts[byte]
+                clogsum += clog[c + n] - clog[c]
+                counts[byte] = c + n
+            total += len(chunk)
+            codes = chunk.translate(classtable)
+            classes = [codes.count(i) for i in range(len(classnames))]
+            classcounts = [a + b for a, b in zip(classcounts, classes)]
+            chunks.append((len(chunk), hist, classes))
+            if len(chunks) < nsteps:
+                continue
+        elif not chunks:
+            return
+
+        ent = math.log2(total) - clogsum / total
+        yield (offset, total, max(ent, 0.0),
+               {name: n / total for name, n in zip(classnames, classcounts)})
+
+        size, hist, classes = chunks.popleft()
+        for byte, n in hist.items():
+            c = counts[byte]
+            clogsum += clog[c - n] - clog[c]
+            counts[byte] = c - n
+        total -= size
+        classcounts = [a - b for a, b in zip(classcounts, classes)]
+        offset += size
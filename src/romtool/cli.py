@@ -57,6 +57,8 @@ def parser_setup(parser, spec, defaults):
     args: {}
     args+:
       nargs: '+'
+    args*:
+      nargs: '*'
     opts: {}
     ropts:
       action: append
@@ -1,14 +1,16 @@
 import argparse
 import sys
-import hashlib
 import logging
 import os
 import shutil
+import contextlib
 import textwrap
-import itertools
 import csv
+import sqlite3
+import glob
 from pprint import pprint
 from itertools import chain
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from importlib.machinery import SourceFileLoader
 
 import yaml
@@ -16,7 +18,7 @@ import yaml
 import romlib
 import romlib.charset
 from romtool import util
-from romtool.util import pkgfile
+from romtool import mapdb
 
 log = logging.getLogger(__name__)
 
@@ -44,33 +46,103 @@ class RomDetectionError(Exception):
                       "be modified, or this may be a save file")
         log.error("You will probably have to explicitly supply --map")
 
-# FIXME: Add subcommand to list available maps on the default search paths.
-# Probably its output should advice the user that it's only what shipped with
-# romtool and they're free to supply their own.
-
 def detect(romfile, maproot=None):
     """ Detect the map to use with a given ROM.
 
     maproot -- A root directory containing a set of rom maps and a hashdb.txt
-               file associating sha1 hashes with map names.
+               file associating sha1 hashes with map names. By default, all
+               roots on the map search path are used; see romtool.mapdb.
+
+    ROMs matching a known hash or header fingerprint are remembered for
+    fuzzy matching. If nothing matches exactly, the map of the most similar
+    known ROM is used, provided they're similar enough.
+    """
+    roots = None if maproot is None else [maproot]
+
+    log.info("Detecting ROM map for: %s.", romfile)
+    romhash = util.romhashes(romfile)['sha1']
+    log.info("sha1 hash is: %s.", romhash)
+    path = mapdb.lookup(romhash, roots) or _lookup_fingerprint(romfile, roots)
+    if path is not None:
+        log.info("ROM map found: %s", path)
+        try:
+            mapdb.learn(romfile, path)
+        except (OSError, sqlite3.Error) as e:
+            log.warning("Couldn't update similarity index: %s", e)
+        return path
+
+    try:
+        matches = mapdb.similar(romfile)
+    except (OSError, sqlite3.Error) as e:
+        log.warning("Couldn't search similarity index: %s", e)
+        matches = []
+    if matches and matches[0][0] >= mapdb.MIN_SIMILARITY:
+        similarity, path = matches[0]
+        log.warning("No exact match for %s; using the map for the most "
+                    "similar known ROM (%.0f%% of blocks match): %s",
+                    romfile, similarity * 100, path)
+        return path
+    raise RomDetectionError(romhash, romfile)
+
+
+def _lookup_fingerprint(romfile, roots=None):
+    try:
+        with open(romfile, 'rb') as f:
+            fingerprint = romlib.rom.fingerprint(f)
+    except romlib.rom.RomFormatError:
+        return None
+    log.info("Header fingerprint is: %s.", fingerprint)
+    return mapdb.lookup(fingerprint, roots)
+
+
+def maps(args):
+    """ List available ROM maps, or the maps matching some ROMs.
+
+    Maps are found on the map search path: any directories listed in
+    $ROMTOOL_MAPS, followed by the maps that ship with romtool. With ROM
+    arguments, prints the keys identifying each ROM and its map, if any,
+    along with how closely the ROM matches a known image.
+
+    With --add, the ROMs are instead recorded as known images for the given
+    map, so that modified copies of them can be matched later.
     """
-    if maproot is None:
-        maproot = pkgfile("maps")
-
-    dbfile = os.path.join(maproot, 'hashdb.txt')
-    with open(dbfile) as hashdb, open(romfile, "rb") as rom:
-        # FIXME: Reads whole file into memory, likely to fail on giant images,
-        # e.g cds/dvds.
-        log.info("Detecting ROM map for: %s.", romfile)
-        romhash = hashlib.sha1(rom.read()).hexdigest()
-        log.info("sha1 hash is: %s.", romhash)
+    if args.add:
+        path = args.add
+        if not os.path.isdir(path):
+            found = [p for name, p in mapdb.index()['maps'] if name == path]
+            if not found:
+                log.error("No such map: %s", path)
+                sys.exit(2)
+            path = found[0]
+        for filename in args.rom:
+            mapdb.learn(filename, path)
+            log.info("Recorded %s as an image for %s", filename, path)
+        return
+
+    if not args.rom:
+        print("Map search path:", file=sys.stderr)
+        for root in mapdb.searchpath():
+            print("    " + root, file=sys.stderr)
+        for name, path in mapdb.index()['maps']:
+            print(name + "\t" + path)
+        return
+
+    print("file\tsha1\tfingerprint\tmap\tsimilarity")
+    for filename in args.rom:
+        sha1 = util.romhashes(filename)['sha1']
         try:
-            line = next(line for line in hashdb if line.startswith(romhash))
-        except StopIteration:
-            raise RomDetectionError(romhash, romfile)
-        name = line.split(maxsplit=1)[1].strip()
-        log.info("ROM map found: %s", name)
-        return os.path.join(maproot, name)
+            with open(filename, 'rb') as f:
+                fingerprint = romlib.rom.fingerprint(f)
+        except romlib.rom.RomFormatError:
+            fingerprint = ""
+        path = (mapdb.lookup(sha1)
+                or fingerprint and mapdb.lookup(fingerprint))
+        similarity = 1.0
+        if not path:
+            matches = mapdb.similar(filename)
+            similarity, path = matches[0] if matches else (0.0, "")
+        row = [filename, sha1, fingerprint, path, "{:.3f}".format(similarity)]
+        print("\t".join(row))
 
 
 def dump(args):
@@ -147,7 +219,7 @@ def build(args):
     source = "save" if args.save else "rom"
     patch = romlib.Patch(rmap.bytemap(data, source))
     _filterpatch(patch, args.rom)
-    _writepatch(patch, args.patch)
+    _writepatch(patch, args.patch, args.rom)
 
 
 def merge(args):
@@ -156,28 +228,55 @@ def merge(args):
     This can accept and merge changes from any number of existing patches and
     formats. Overlapping changes will produce a warning. Last changeset
     specified on the command line wins.
+
+    Each patch's changes are fed through a k-way merge in offset order, so
+    overlaps are resolved a run at a time and the output is written as it is
+    produced. --conflicts writes the list of conflicting ranges to a file.
     """
-    changeset = romlib.util.CheckedDict()
+    sources = []
     for patchfile in args.patches:
         msg = "Importing changes from %s."
         log.info(msg, patchfile)
-        changeset.update(romlib.Patch.load(patchfile).changes)
-
-    # Filter the complete changeset against a target ROM if asked.
-    patch = romlib.Patch(changeset)
-    _filterpatch(patch, args.rom)
-    _writepatch(patch, args.out)
+        patch = romlib.Patch.load(patchfile, rom=args.rom)
+        sources.append(patch.changes.blocks())
+
+    conflicts = []
+    blocks = romlib.patch.merge(sources, conflicts)
+    with contextlib.ExitStack() as stack:
+        # Filter the changeset against a target ROM if asked.
+        if args.rom is not None:
+            log.info("Filtering changes against %s.", args.rom)
+            rom = stack.enter_context(open(args.rom, "rb"))
+            orig = stack.enter_context(romlib.util.filebuffer(rom))
+            blocks = romlib.patch.filter_blocks(blocks, orig)
+        _writeblocks(blocks, args.out, args.rom)
+
+    rows = []
+    for start, end, indexes in conflicts:
+        names = [args.patches[i] for i in indexes]
+        log.warning("Conflict: %06X-%06X: %s", start, end - 1,
+                    ", ".join(names))
+        rows.append({"start": "0x{:06X}".format(start),
+                     "end": "0x{:06X}".format(end - 1),
+                     "patches": ", ".join(names)})
+    if conflicts:
+        log.warning("%s conflicting ranges; last patch listed wins.",
+                    len(conflicts))
+    if args.conflicts:
+        log.info("Writing conflict report to %s.", args.conflicts)
+        romlib.util.writetsv(args.conflicts, rows, True,
+                             ["start", "end", "patches"])
 
 
 def convert(args):
     """ Convert one patch format to another.
 
-    This is just syntactic sugar over merge.
+    The patch is streamed from one file to the other a record at a time, so
+    this works on patches of any size. BPS and UPS patches are relative to
+    the original ROM, which must be supplied with --rom.
     """
-    args.patches = [args.infile]
-    args.out = args.outfile
-    args.rom = None
-    merge(args)
+    log.info("Converting %s to %s.", args.infile, args.outfile)
+    romlib.patch.convert(args.infile, args.outfile, rom=args.rom)
 
 
 def diff(args):
@@ -189,23 +288,42 @@ def diff(args):
     with open(args.original, "rb") as original:
         with open(args.modified, "rb") as changed:
             patch = romlib.Patch.from_diff(original, changed)
-    _writepatch(patch, args.out)
+    _writepatch(patch, args.out, args.original)
 
 def apply(args):
-    """ Apply a patch to a file, such as a rom or a save.
+    """ Apply a patch to one or more files, such as roms or saves.
 
-    By default this makes a backup of the existing file at filename.bak.
+    By default this makes a backup of each existing file at filename.bak.
+    Targets are patched in parallel; --jobs sets how many at once.
     """
-    # Move the target to a backup name first to preserve its metadata, then
-    # copy it back to its original name, then patch it there.
-    patch = romlib.Patch.load(args.patch)
-    tgt = args.target
-    _backup(args.target, args.nobackup)
-    log.info("Applying patch")
-    with open(tgt, "r+b") as f:
-        patch.apply(f)
-    log.warning("Patch applied. Note: You may want to run `romtool "
-                    "sanitize` next, especially if this is a save file.")
+    if romlib.patch.needs_rom(args.patch):
+        # BPS and UPS patches are relative to the file they're applied to, so
+        # they have to be decoded separately for each target.
+        blocks = None
+    else:
+        patch = romlib.Patch.load(args.patch)
+        blocks = list(patch.changes.blocks())
+    jobs = romlib.util.intify(args.jobs, None)
+    log.info("Applying patch to %s target(s)", len(args.target))
+    failed = []
+    with ThreadPoolExecutor(jobs) as pool:
+        futures = [pool.submit(_apply, args.patch, blocks, target,
+                               args.nobackup)
+                   for target in args.target]
+        for target, future in zip(args.target, futures):
+            try:
+                future.result()
+            except Exception as e:
+                log.error("Failed to patch %s: %s", target, e)
+                failed.append(target)
+            else:
+                log.info("Patched %s", target)
+    if len(failed) < len(args.target):
+        log.warning("Patch applied. Note: You may want to run `romtool "
+                        "sanitize` next, especially if this is a save file.")
+    if failed:
+        log.error("%s of %s targets failed", len(failed), len(args.target))
+        sys.exit(2)
 
 
 def sanitize(args):
@@ -260,50 +378,44 @@ def sanitize(args):
 
 
 def charmap(args):
+    """ Generate a text character set from known strings.
+
+    Searches one or more roms, e.g. different releases of the same game, for
+    the strings in a file, and prints every character set consistent with all
+    of them. The search is split across a process pool; --jobs sets how many
+    processes to use.
+    """
     # FIXME: Much of this should probably be moved into the text module or
     # something.
     log.info("Loading strings")
     with open(args.strings) as f:
         strings = [s.strip() for s in f]
 
-    log.info("Loading rom")
-    with open(args.rom, "rb") as rom:
-        data = rom.read()
-        view = memoryview(data)
-    log.debug("rom length: %s bytes", len(data))
-
+    roms = [args.rom] + (args.roms or [])
+    jobs = romlib.util.intify(args.jobs, None) or os.cpu_count() or 1
     log.info("Starting search")
     maps = {s: [] for s in strings}
-    for s in strings:
-        log.debug("Searching for %s", s)
-        pattern = romlib.charset.Pattern(s)
-        for i in range(len(data) - len(s) + 1):
-            chunk = view[i:i+len(s)]
-            try:
-                cmap = pattern.buildmap(chunk)
-            except romlib.charset.NoMapping:
-                continue
-            log.debug("Found match for %s at %s", s, i)
-            if cmap in maps[s]:
-                log.debug("Duplicate mapping, skipping")
-            else:
-                log.info("New mapping found for '%s' at %s", s, i)
-                maps[s].append(cmap)
+    with ProcessPoolExecutor(jobs) as pool:
+        futures = [pool.submit(_charmap_search, rom, strings, start, stop)
+                   for rom in roms
+                   for start, stop in _shards(os.path.getsize(rom), jobs)]
+        # Results are collected in submission order, not completion order,
+        # so the output is the same however the work gets split up.
+        for future in futures:
+            for s, i, cmap in future.result():
+                log.debug("Found match for %s at %s", s, i)
+                if cmap in maps[s]:
+                    log.debug("Duplicate mapping, skipping")
+                else:
+                    log.info("New mapping found for '%s' at %s", s, i)
+                    maps[s].append(cmap)
 
+    for s in strings:
         found = len(maps[s])
         msg = "Found %s possible mappings for '%s'"
         log.info(msg, found, s)
 
-    charsets = []
-    for m in itertools.product(*maps.values()):
-        try:
-            merged = romlib.charset.merge(*m)
-        except romlib.charset.MappingConflictError:
-            log.debug("Mapping conflict")
-            pass
-        else:
-            log.info("Found consistent character map.")
-            charsets.append(merged)
+    charsets = romlib.charset.merge_candidates(maps.values())
 
     if len(charsets) == 0:
         log.error("Could not find any consistent character set")
@@ -317,36 +429,31 @@ def charmap(args):
             print("{:02X}={}".format(byte, char))
 
 def blocks(args):
+    """ Search for blocks of unused space.
+
+    Reports runs of a single repeated byte. --byte and --range may be given
+    more than once, to look for several fill bytes or in several parts of
+    the rom.
+    """
     # Most users likely use Windows, so I can't rely on them having sort, head,
     # etc or equivalents available, nor that they'll know how to use them.
     # Hence some extra args that shouldn't be necessary but are.
-    args.byte = romlib.util.intify(args.byte, None)
+    values = None
+    if args.byte:
+        values = {romlib.util.intify(b) for b in args.byte}
     args.num = romlib.util.intify(args.num, None)
     args.min = romlib.util.intify(args.min, 16)
 
-    log.info("Loading rom")
-    with open(args.rom, "rb") as rom:
-        data = rom.read()
-
-    log.debug("rom length: %s bytes", len(data))
-    log.info("Starting search")
-
     blocks = []
-    blocklen = 1
-    last = None
-    for i, byte in enumerate(data):
-        if last is not None and byte != last:
-            # End of block. Add to the list if it's long enough to care. If the
-            # user specified a byte to search for and this isn't it, skip it.
-            if blocklen > args.min:
-                if args.byte is None or last == args.byte:
-                    log.debug("Noting block at %s", i-blocklen)
-                    blocks.append((blocklen, i-blocklen, last))
-            blocklen = 1
-            last = None
-        else:
-            blocklen += 1
-            last = byte
+    with open(args.rom, "rb") as rom, romlib.util.filebuffer(rom) as data:
+        log.debug("rom length: %s bytes", len(data))
+        ranges = [_parserange(r, len(data)) for r in args.range or []]
+        for start, end in ranges or [(0, len(data))]:
+            log.info("Searching %06X-%06X", start, end)
+            with memoryview(data)[start:end] as view:
+                blocks.extend((length, start + offset, byte)
+                              for offset, length, byte
+                              in romlib.util.findruns(view, args.min, values))
 
     blocks.sort(reverse=True)
     print("offset\tblkbyte\tlength\thexlen")
@@ -354,31 +461,83 @@ def blocks(args):
         fmt = "{:06X}\t0x{:02X}\t{}\t{:X}"
         print(fmt.format(offset, byte, length, length))
 
+
+def _parserange(text, size):
+    """ Parse a 'start:end' offset range. Either end may be omitted."""
+    start, sep, end = text.partition(":")
+    if not sep:
+        raise ValueError("Bad range '{}'; expected start:end".format(text))
+    start = romlib.util.intify(start, 0) if start else 0
+    end = romlib.util.intify(end, size) if end else size
+    return max(start, 0), min(end, size)
+
+
+def entropy(args):
+    """ Profile the entropy and byte makeup of a rom, region by region.
+
+    High entropy suggests compressed or encrypted data; low entropy with lots
+    of printable bytes suggests text; near-zero entropy is likely free space.
+    Each row covers --window bytes, and rows are --step bytes apart.
+
+    With --binary, the output is instead one byte per row, giving entropy
+    scaled to 0-255. That's compact and can be viewed as a raw greyscale
+    image.
+    """
+    window = romlib.util.intify(args.window, 1024)
+    step = romlib.util.intify(args.step, 256)
+
+    with contextlib.ExitStack() as stack:
+        rom = stack.enter_context(open(args.rom, "rb"))
+        rows = romlib.util.profile(rom, window, step)
+        if args.binary:
+            out = (stack.enter_context(open(args.out, "wb")) if args.out
+                   else sys.stdout.buffer)
+            for offset, size, ent, classes in rows:
+                out.write(bytes([round(ent * 255 / 8)]))
+            return
+
+        out = (stack.enter_context(open(args.out, "w", newline=''))
+               if args.out else sys.stdout)
+        classnames = [name for name, members in romlib.util.BYTE_CLASSES]
+        columns = ["offset", "size", "entropy"] + classnames + ["other"]
+        writer = csv.DictWriter(out, columns, dialect='romtool')
+        writer.writeheader()
+        for offset, size, ent, classes in rows:
+            row = {"offset": "{:06X}".format(offset),
+                   "size": size,
+                   "entropy": "{:.3f}".format(ent)}
+            row.update((k, "{:.3f}".format(v)) for k, v in classes.items())
+            writer.writerow(row)
+
+
 def meta(args):
-    """ Print rom metadata, e.g. console and header info"""
+    """ Print rom metadata, e.g. console and header info
 
+    Arguments may be files, directories or glob patterns. Files are inspected
+    in parallel; --jobs sets how many at once. Different types of rom have
+    different headers, so a new header row is printed whenever the columns
+    change.
+    """
     writer = None
-    for filename in args.rom:
-        log.info("Inspecting ROM: %s", filename)
-        with open(filename, 'rb') as romfile:
-            try:
-                rom = romlib.rom.Rom.make(romfile)
-            except romlib.rom.RomFormatError as e:
-                log.error("Error inspecting %s: %s", filename, str(e))
-                continue
-        header_data = {"File": filename}
-        header_data.update(rom.header.dump())
-        columns = ['File'] + romlib.struct.output_fields(rom.header)
-        if not writer:
+    for filename, result in _inspect_all(args.rom, args.jobs):
+        romtype, header_data, columns = result
+        header_data["File"] = filename
+        columns = ['File'] + columns
+        if not writer or writer.fieldnames != columns:
             writer = csv.DictWriter(sys.stdout, columns, dialect='romtool')
             writer.writeheader()
         writer.writerow(header_data)
 
 
 def identify(args):
-    for filename in args.rom:
-        with open(filename, 'rb') as romfile:
-            print(romlib.rom.identify(romfile) + "\t" + filename)
+    """ Identify rom types
+
+    Arguments may be files, directories or glob patterns. Files are inspected
+    in parallel; --jobs sets how many at once.
+    """
+    for filename, result in _inspect_all(args.rom, args.jobs):
+        romtype, header_data, columns = result
+        print(romtype + "\t" + filename)
 
 
 def _backup(filename, skip=False):
@@ -392,6 +551,21 @@ def _backup(filename, skip=False):
         log.warning("Backup suppressed")
 
 
+def _apply(patchfile, blocks, target, nobackup=False):
+    """ Back up and patch a single target. Run from apply's worker pool.
+
+    If blocks is None, the patch is loaded against this target first.
+    """
+    if blocks is None:
+        patch = romlib.Patch.load(patchfile, rom=target)
+        blocks = list(patch.changes.blocks())
+    # Move the target to a backup name first to preserve its metadata, then
+    # copy it back to its original name, then patch it there.
+    _backup(target, nobackup)
+    with open(target, "r+b") as f:
+        romlib.patch.apply_blocks(blocks, f)
+
+
 def _filterpatch(patch, romfile):
     # Fixme: Ask forgiveness, not permission here? And should the check be
     # handled by the caller?
@@ -402,14 +576,109 @@ def _filterpatch(patch, romfile):
                 patch.filter(rom)
 
 
-def _writepatch(patch, outfile):
+def _writeblocks(blocks, outfile, rom=None):
+    """ Stream a sequence of change blocks to a patch file.
+
+    Like _writepatch, but the blocks are written as they're produced.
+    """
+    changes = 0
+
+    def counted(blocks):
+        nonlocal changes
+        for offset, data in blocks:
+            changes += len(data)
+            yield offset, data
+
+    if outfile:
+        log.info("Creating patch at %s.", outfile)
+        romlib.patch.write_blocks(outfile, counted(blocks), rom=rom)
+    else:
+        romlib.patch.write_ipst(sys.stdout, counted(blocks))
+    log.info("There were %s changes.", changes)
+
+
+def _writepatch(patch, outfile, rom=None):
     """ Write a patch to a file.
 
-    Logs a bit if needed and redirects to stdout if needed.
+    Logs a bit if needed and redirects to stdout if needed. rom is the
+    original ROM, for formats that need it.
     """
     if outfile:
         log.info("Creating patch at %s.", outfile)
-        patch.save(outfile)
+        patch.save(outfile, rom=rom)
     else:
         patch.to_ipst(sys.stdout)
     log.info("There were %s changes.", len(patch.changes))
+
+
+def _romfiles(paths):
+    """ Expand a list of files, directories and globs into filenames.
+
+    Directories are walked recursively. Output is sorted within each
+    argument, but arguments are kept in the order given.
+    """
+    for path in paths:
+        if glob.has_magic(path):
+            matches = sorted(glob.glob(path, recursive=True))
+        else:
+            matches = [path]
+        for match in matches:
+            if not os.path.isdir(match):
+                yield match
+                continue
+            for root, dirs, files in os.walk(match):
+                dirs.sort()
+                for filename in sorted(files):
+                    yield os.path.join(root, filename)
+
+
+def _inspect(filename):
+    """ Detect a rom's type and read its header.
+
+    Returns (romtype, header data, header columns). This runs in worker
+    processes, so it returns plain data rather than header objects.
+    """
+    with open(filename, 'rb') as romfile:
+        romcls, header = romlib.rom.detect(romfile)
+    columns = romlib.struct.output_fields(type(header))
+    return romcls.romtype, header.dump(), columns
+
+
+def _inspect_all(paths, jobs=None):
+    """ Inspect roms in a process pool, yielding results in input order.
+
+    Yields (filename, result) pairs, where result is as for _inspect. Files
+    that can't be read or identified are logged and skipped.
+    """
+    jobs = romlib.util.intify(jobs, None)
+    filenames = list(_romfiles(paths))
+    log.info("Inspecting %s file(s)", len(filenames))
+    with ProcessPoolExecutor(jobs) as pool:
+        futures = [pool.submit(_inspect, filename) for filename in filenames]
+        for filename, future in zip(filenames, futures):
+            try:
+                yield filename, future.result()
+            except (OSError, romlib.rom.RomFormatError) as e:
+                log.error("Error inspecting %s: %s", filename, str(e))
+
+
+def _shards(size, jobs, minsize=2**16):
+    """ Split a file into roughly equal pieces for a process pool.
+
+    Aims for a few pieces per job, so that uneven pieces even out, but
+    doesn't bother splitting small files very finely.
+    """
+    count = max(1, min(jobs * 4, size // minsize))
+    step = romlib.util.divup(size, count) or 1
+    return [(start, min(start + step, size))
+            for start in range(0, max(size, 1), step)]
+
+
+def _charmap_search(filename, strings, start, stop):
+    """ Search part of a rom for known strings.
+
+    This runs in worker processes. Each maps the rom itself rather than
+    having it sent over, and returns a list of (string, offset, charset).
+    """
+    with open(filename, "rb") as rom, romlib.util.filebuffer(rom) as data:
+        return list(romlib.charset.search(data, strings, start, stop))
@@ -0,0 +1,249 @@
+""" Registry of known ROM maps across one or more map roots.
+
+A map root is a directory of map directories, plus a hashdb.txt file that
+associates ROMs with maps. Each line of hashdb.txt is a key followed by a map
+name. Keys are normally sha1 hashes of the whole ROM file, but may also be a
+header fingerprint as printed by `romtool maps <rom>`, which still matches
+copies that differ only by a copier header.
+
+Roots are searched in order: those listed in $ROMTOOL_MAPS (separated by
+os.pathsep), then the maps shipped with romtool. Where roots disagree, the
+first one wins, so user maps can override shipped ones.
+
+Scanning every root on every run gets slow with large map libraries, so the
+merged index is cached and only rebuilt when a root's contents change.
+
+ROMs that don't match any key exactly can still be matched to the most
+similar known image; see `learn` and `similar`.
+"""
+
+import os
+import json
+import hashlib
+import logging
+import sqlite3
+import contextlib
+from os.path import join as pathjoin
+
+import romlib.rom
+import romlib.util
+from romtool import util
+
+log = logging.getLogger(__name__)
+
+# Bump this when the index layout changes, to force a rebuild.
+_INDEX_VERSION = 1
+
+
+def searchpath():
+    """ Get the list of map roots to search, in priority order."""
+    roots = [os.path.expanduser(root) for root
+             in os.environ.get('ROMTOOL_MAPS', '').split(os.pathsep)
+             if root]
+    roots.append(util.pkgfile("maps"))
+    return roots
+
+
+def _stamp(roots):
+    """ Get a summary of roots' state, for checking whether an index is stale.
+
+    This covers each root directory (which changes when maps are added or
+    removed) and its hashdb.txt.
+    """
+    stamp = []
+    for root in roots:
+        for path in root, pathjoin(root, 'hashdb.txt'):
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                stamp.append([path, None, None])
+            else:
+                stamp.append([path, stat.st_mtime_ns, stat.st_size])
+    return stamp
+
+
+def _scan(roots):
+    """ Build a map index from scratch."""
+    keys = {}
+    maps = []
+    for root in roots:
+        log.debug("Scanning map root %s", root)
+        try:
+            names = sorted(entry.name for entry in os.scandir(root)
+                           if entry.is_dir())
+        except FileNotFoundError:
+            log.warning("Map root %s does not exist", root)
+            continue
+        maps.extend([name, pathjoin(root, name)] for name in names)
+        try:
+            with open(pathjoin(root, 'hashdb.txt')) as hashdb:
+                lines = [line.strip().split(maxsplit=1)
+                         for line in hashdb if line.strip()]
+        except FileNotFoundError:
+            continue
+        for key, name in lines:
+            path = pathjoin(root, name)
+            if key not in keys:
+                keys[key] = path
+            elif keys[key] != path:
+                log.warning("%s is claimed by both %s and %s; using the "
+                            "first", key, keys[key], path)
+    return {'version': _INDEX_VERSION,
+            'stamp': _stamp(roots),
+            'keys': keys,
+            'maps': maps}
+
+
+_indexes = {}
+
+
+def index(roots=None):
+    """ Get the merged index of a list of map roots.
+
+    The index is a dictionary with 'keys', mapping sha1 hashes and header
+    fingerprints to map paths, and 'maps', a list of [name, path] pairs for
+    every map found. Indexes are cached both in memory and on disk.
+    """
+    roots = tuple(searchpath() if roots is None else roots)
+    stamp = _stamp(roots)
+    if roots in _indexes and _indexes[roots]['stamp'] == stamp:
+        return _indexes[roots]
+
+    # Several sets of roots can be in use, e.g. via detect(maproot=...), so
+    # each gets its own cache file.
+    digest = hashlib.sha1("\0".join(roots).encode()).hexdigest()
+    # JSON rather than YAML, because the pure-Python YAML loader is slower
+    # than just rescanning.
+    cachename = "maps-{}.json".format(digest[:16])
+    path = util.cachefile(cachename)
+    try:
+        with open(path) as f:
+            idx = json.load(f)
+    except (OSError, ValueError):
+        idx = None
+    if (not isinstance(idx, dict)
+            or idx.get('version') != _INDEX_VERSION
+            or idx.get('stamp') != stamp):
+        log.info("Rebuilding map index")
+        idx = _scan(roots)
+        tmp = "{}.{}".format(path, os.getpid())
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp, 'w') as f:
+                json.dump(idx, f)
+            os.replace(tmp, path)
+        except OSError as e:
+            log.warning("Couldn't save map index %s: %s", path, e)
+    _indexes[roots] = idx
+    return idx
+
+
+def lookup(key, roots=None):
+    """ Get the path of the map for a sha1 or fingerprint, or None."""
+    return index(roots)['keys'].get(key)
+
+
+# Fuzzy matching
+#
+# ROMs that have been patched don't match anything by hash, but most of their
+# contents are usually still identical to a known image. Each known image is
+# recorded as the set of hashes of its fixed-size blocks, with the copier
+# header stripped so that headered and unheadered copies line up. An unknown
+# ROM is compared by looking up its own block hashes, which only touches the
+# images that share at least one block.
+
+BLOCK_SIZE = 1024
+MIN_SIMILARITY = 0.5
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS roms (
+    id INTEGER PRIMARY KEY,
+    sha1 TEXT UNIQUE NOT NULL,
+    map TEXT NOT NULL,
+    nblocks INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS blocks (
+    hash INTEGER NOT NULL,
+    rom INTEGER NOT NULL REFERENCES roms(id),
+    PRIMARY KEY (hash, rom)
+) WITHOUT ROWID;
+"""
+
+
+def _connect():
+    path = util.cachefile('blocks.sqlite')
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    db = sqlite3.connect(path)
+    db.executescript(_SCHEMA)
+    return db
+
+
+def _hashblocks(data):
+    """ Get the set of block hashes for a buffer.
+
+    Blocks that are a single repeated byte are left out; they're usually
+    padding or free space, and would make unrelated images look alike.
+    """
+    hashes = set()
+    for i in range(0, len(data), BLOCK_SIZE):
+        block = bytes(data[i:i+BLOCK_SIZE])
+        if block.count(block[0]) == len(block):
+            continue
+        digest = hashlib.blake2b(block, digest_size=8).digest()
+        hashes.add(int.from_bytes(digest, 'big', signed=True))
+    return hashes
+
+
+def _blockhashes(filename):
+    """ Get the set of block hashes for a ROM file, minus any header."""
+    with open(filename, 'rb') as f:
+        try:
+            with romlib.rom.Rom.make(f) as rom:
+                return _hashblocks(rom.data)
+        except romlib.rom.RomFormatError:
+            pass
+        with romlib.util.filebuffer(f) as buf:
+            return _hashblocks(buf)
+
+
+def learn(filename, mappath):
+    """ Record a ROM as a known image for a map, for fuzzy matching."""
+    sha1 = util.romhashes(filename)['sha1']
+    with contextlib.closing(_connect()) as db, db:
+        if db.execute("SELECT 1 FROM roms WHERE sha1 = ?",
+                      (sha1,)).fetchone():
+            db.execute("UPDATE roms SET map = ? WHERE sha1 = ?",
+                       (mappath, sha1))
+            return
+        log.info("Recording block hashes for %s", filename)
+        hashes = _blockhashes(filename)
+        romid = db.execute(
+                "INSERT INTO roms (sha1, map, nblocks) VALUES (?, ?, ?)",
+                (sha1, mappath, len(hashes))).lastrowid
+        db.executemany("INSERT INTO blocks (hash, rom) VALUES (?, ?)",
+                       ((h, romid) for h in hashes))
+
+
+def similar(filename, limit=1):
+    """ Find the known images most similar to a ROM.
+
+    Returns a list of up to `limit` (similarity, map path) pairs, best first.
+    Similarity is the fraction of the ROM's distinct blocks that are also in
+    the known image, from 0 to 1. Ties go to the image with the fewest blocks
+    the ROM doesn't have.
+    """
+    hashes = _blockhashes(filename)
+    if not hashes:
+        return []
+    with contextlib.closing(_connect()) as db:
+        db.execute("CREATE TEMP TABLE query (hash INTEGER PRIMARY KEY)")
+        db.executemany("INSERT INTO query VALUES (?)",
+                       ((h,) for h in hashes))
+        rows = db.execute("""
+            SELECT roms.map, roms.nblocks, COUNT(*)
+            FROM query JOIN blocks USING (hash)
+            JOIN roms ON roms.id = blocks.rom
+            GROUP BY blocks.rom""").fetchall()
+    rows.sort(key=lambda row: (-row[2], row[1] - row[2], row[0]))
+    return [(shared / len(hashes), mappath)
+            for mappath, nblocks, shared in rows[:limit]]
@@ -1,10 +1,14 @@
-from os.path import realpath, dirname
+import os
+import csv
+from os.path import realpath, dirname, expanduser
 from os.path import join as pathjoin
 
 import yaml
 import logging
 import logging.config
 
+import romlib.util
+
 log = logging.getLogger(__name__)
 
 def whereami(path):
@@ -18,6 +22,57 @@ def whereami(path):
 def pkgfile(filename):
     return pathjoin(whereami(__file__), filename)
 
+def cachefile(filename):
+    """ Get the path to a file in romtool's cache directory."""
+    root = os.environ.get('XDG_CACHE_HOME') or expanduser('~/.cache')
+    return pathjoin(root, 'romtool', filename)
+
+_hash_keys = ['path', 'size', 'mtime', 'inode']
+_hash_types = ['sha1', 'crc32', 'md5']
+
+def _loadhashes(path):
+    try:
+        rows = romlib.util.readtsv(path)
+        return {tuple(row[k] for k in _hash_keys): row for row in rows}
+    except FileNotFoundError:
+        return {}
+    except (OSError, csv.Error, KeyError) as e:
+        log.warning("Ignoring unreadable hash cache %s: %s", path, e)
+        return {}
+
+def romhashes(filename):
+    """ Get the sha1, crc32 and md5 hashes of a file, via the hash cache.
+
+    Cache entries are keyed on the file's real path, size, mtime and inode,
+    so anything that has changed since it was last seen gets rehashed. A
+    cache that can't be written is logged and otherwise ignored.
+    """
+    path = realpath(filename)
+    stat = os.stat(path)
+    key = (path, str(stat.st_size), str(stat.st_mtime_ns), str(stat.st_ino))
+    dbpath = cachefile('hashes.tsv')
+    cache = _loadhashes(dbpath)
+    if key in cache:
+        log.debug("Hash cache hit for %s", path)
+        return {k: cache[key][k] for k in _hash_types}
+
+    log.debug("Hashing %s", path)
+    with open(path, 'rb') as f:
+        hashes = romlib.util.filehashes(f)
+    row = dict(zip(_hash_keys, key))
+    row.update(hashes)
+    # Drop stale entries for the same file.
+    rows = [r for k, r in cache.items() if k[0] != path]
+    rows.append(row)
+    tmp = "{}.{}".format(dbpath, os.getpid())
+    try:
+        os.makedirs(dirname(dbpath), exist_ok=True)
+        romlib.util.writetsv(tmp, rows, True, _hash_keys + _hash_types)
+        os.replace(tmp, dbpath)
+    except (OSError, csv.Error) as e:
+        log.warning("Couldn't update hash cache %s: %s", dbpath, e)
+    return hashes
+
 def loadyaml(data):
     # Just so I don't have to remember the extra argument everywhere.
     # Should take anything yaml.load will take.
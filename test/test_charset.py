@@ -0,0 +1,76 @@
+import unittest
+
+from romlib import charset
+
+
+def encode(text):
+    """ Encode text in a made-up but plausible game character set."""
+    table = {" ": 0x00, ".": 0x11, "!": 0x12}
+    for start, chars in ((0x20, "abcdefghijklmnopqrstuvwxyz"),
+                         (0x50, "ABCDEFGHIJKLMNOPQRSTUVWXYZ"),
+                         (0x80, "123456789")):
+        table.update((c, start + i) for i, c in enumerate(chars))
+    return bytes(table[c] for c in text)
+
+
+class TestSearch(unittest.TestCase):
+    def setUp(self):
+        self.data = (bytes(range(256)) + encode("Hello there.")
+                     + bytes(range(255, -1, -1)) + encode("a b c"))
+
+    def test_deltas(self):
+        data = bytes([1, 3, 0, 0xFF])
+        self.assertEqual(charset.deltas(data), bytes([2, 0xFD, 0xFF]))
+        self.assertEqual(charset.deltas(data, 2), bytes([0xFF, 0xFC]))
+
+    def test_search_finds_string(self):
+        matches = list(charset.search(self.data, ["Hello there."]))
+        self.assertEqual(len(matches), 1)
+        s, offset, cmap = matches[0]
+        self.assertEqual(offset, 256)
+        self.assertEqual(cmap["H"], 0x57)
+        self.assertEqual(cmap["."], 0x11)
+
+    def test_search_without_adjacent_letters(self):
+        pattern = charset.Pattern("a b c")
+        self.assertEqual(pattern.gap, 2)
+        offsets = [offset for offset, cmap in pattern.search(self.data)]
+        self.assertIn(len(self.data) - 5, offsets)
+
+    def test_search_matches_brute_force(self):
+        pattern = charset.Pattern("Hello there.")
+        expected = []
+        for i in range(len(self.data) - pattern.length + 1):
+            try:
+                cmap = pattern.buildmap(self.data[i:i+pattern.length])
+            except charset.NoMapping:
+                continue
+            expected.append((i, cmap))
+        self.assertEqual(list(pattern.search(self.data)), expected)
+
+    def test_search_in_pieces(self):
+        strings = ["Hello there.", "a b c"]
+        whole = list(charset.search(self.data, strings))
+        pieces = []
+        for start in range(0, len(self.data), 100):
+            pieces.extend(charset.search(self.data, strings,
+                                         start, start + 100))
+        self.assertEqual(sorted(pieces, key=lambda m: m[:2]),
+                         sorted(whole, key=lambda m: m[:2]))
+
+
+class TestMergeCandidates(unittest.TestCase):
+    def test_conflicts_pruned(self):
+        candidates = [[{"a": 1}, {"a": 2}],
+                      [{"a": 1, "b": 2}],
+                      [{"c": 3}, {"b": 5}]]
+        self.assertEqual(charset.merge_candidates(candidates),
+                         [{"a": 1, "b": 2, "c": 3}])
+
+    def test_duplicates_merged(self):
+        candidates = [[{"a": 1}, {"a": 1, "b": 2}], [{"b": 2}]]
+        self.assertEqual(charset.merge_candidates(candidates),
+                         [{"a": 1, "b": 2}])
+
+    def test_no_candidates(self):
+        self.assertEqual(charset.merge_candidates([[{"a": 1}], []]), [])
@@ -0,0 +1,68 @@
+import io
+import os
+import unittest
+from argparse import Namespace
+from contextlib import redirect_stdout
+from tempfile import TemporaryDirectory
+
+from romlib import rom
+from romtool import commands
+
+
+def inesrom():
+    return b"NES\x1a\x02\x01" + bytes(10) + bytes(0x8000)
+
+
+def snesrom():
+    data = bytearray(0x8000)
+    header = bytearray(64)
+    header[16:37] = b"TEST ROM".ljust(21)
+    header[37] = 0x20
+    header[39] = 5
+    data[rom.SNESRom.ofs_lorom:rom.SNESRom.ofs_lorom+64] = header
+    return bytes(data)
+
+
+class TestInspect(unittest.TestCase):
+    def setUp(self):
+        tmp = TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp = tmp.name
+        os.makedirs(os.path.join(self.tmp, 'roms', 'sub'))
+        self.files = {'roms/b.sfc': snesrom(),
+                      'roms/a.nes': inesrom(),
+                      'roms/sub/c.nes': inesrom(),
+                      'roms/junk.bin': b"not a rom"}
+        for name, data in self.files.items():
+            with open(self.path(name), 'wb') as f:
+                f.write(data)
+
+    def path(self, name):
+        return os.path.join(self.tmp, *name.split('/'))
+
+    def test_romfiles_order(self):
+        paths = [self.path('roms/b.sfc'), self.path('roms'),
+                 self.path('roms/*.nes')]
+        self.assertEqual(list(commands._romfiles(paths)),
+                         [self.path(name) for name in
+                          ['roms/b.sfc', 'roms/a.nes', 'roms/b.sfc',
+                           'roms/junk.bin', 'roms/sub/c.nes',
+                           'roms/a.nes']])
+
+    def test_inspect_all_skips_unknown(self):
+        results = list(commands._inspect_all([self.path('roms')], jobs=2))
+        self.assertEqual([(filename, result[0])
+                          for filename, result in results],
+                         [(self.path('roms/a.nes'), 'ines'),
+                          (self.path('roms/b.sfc'), 'snes'),
+                          (self.path('roms/sub/c.nes'), 'ines')])
+
+    def test_meta_mixed_types(self):
+        out = io.StringIO()
+        args = Namespace(rom=[self.path('roms')], jobs=1)
+        with redirect_stdout(out):
+            commands.meta(args)
+        lines = out.getvalue().splitlines()
+        headers = [line for line in lines if line.startswith('File')]
+        self.assertEqual(len(headers), 3)
+        self.assertEqual(len(lines), 6)
@@ -0,0 +1,149 @@
+import os
+import random
+import unittest
+from unittest import mock
+from tempfile import TemporaryDirectory
+
+from romlib import rom
+from romtool import mapdb
+
+
+def inesrom(prg=None):
+    return b"NES\x1a\x02\x01" + bytes(10) + (prg or bytes(0x8000))
+
+
+def snesrom(data, smc=False):
+    """ Give a LoROM image a valid internal header."""
+    data = bytearray(data)
+    header = bytearray(64)
+    header[16:37] = b"TEST ROM".ljust(21)
+    header[37] = 0x20
+    header[39] = 5
+    data[rom.SNESRom.ofs_lorom:rom.SNESRom.ofs_lorom+64] = header
+    return (bytes(0x200) if smc else b"") + bytes(data)
+
+
+def noise(size, seed=0):
+    rand = random.Random(seed)
+    return bytes(rand.getrandbits(8) for i in range(size))
+
+
+class MapDBTestCase(unittest.TestCase):
+    """ Base for tests that need map roots and a private cache directory."""
+    def setUp(self):
+        tmp = TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp = tmp.name
+        env = mock.patch.dict(os.environ, {
+            'XDG_CACHE_HOME': os.path.join(self.tmp, 'cache'),
+            'ROMTOOL_MAPS': ''})
+        env.start()
+        self.addCleanup(env.stop)
+        mapdb._indexes.clear()
+        self.addCleanup(mapdb._indexes.clear)
+
+    def makeroot(self, name, maps, hashdb):
+        root = os.path.join(self.tmp, name)
+        for mapname in maps:
+            os.makedirs(os.path.join(root, mapname))
+        self.writehashdb(root, hashdb)
+        return root
+
+    def writehashdb(self, root, hashdb):
+        with open(os.path.join(root, 'hashdb.txt'), 'w') as f:
+            for key, mapname in hashdb.items():
+                f.write("{} {}\n".format(key, mapname))
+
+    def writefile(self, name, data):
+        path = os.path.join(self.tmp, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+
+class TestIndex(MapDBTestCase):
+    def test_first_root_wins(self):
+        user = self.makeroot('user', ['game'], {'aaaa': 'game'})
+        shipped = self.makeroot('shipped', ['game', 'other'],
+                                {'aaaa': 'game', 'bbbb': 'other'})
+        roots = [user, shipped]
+        self.assertEqual(mapdb.lookup('aaaa', roots),
+                         os.path.join(user, 'game'))
+        self.assertEqual(mapdb.lookup('bbbb', roots),
+                         os.path.join(shipped, 'other'))
+        self.assertIsNone(mapdb.lookup('cccc', roots))
+        names = [name for name, path in mapdb.index(roots)['maps']]
+        self.assertEqual(names, ['game', 'game', 'other'])
+
+    def test_searchpath(self):
+        user = self.makeroot('user', ['game'], {})
+        with mock.patch.dict(os.environ, {'ROMTOOL_MAPS': user}):
+            roots = mapdb.searchpath()
+        self.assertEqual(roots[0], user)
+        self.assertEqual(len(roots), 2)
+
+    def test_stale_index_rebuilt(self):
+        root = self.makeroot('maps', ['game'], {'aaaa': 'game'})
+        self.assertIsNone(mapdb.lookup('bbbb', [root]))
+        os.makedirs(os.path.join(root, 'other'))
+        self.writehashdb(root, {'aaaa': 'game', 'bbbb': 'other'})
+        self.assertEqual(mapdb.lookup('bbbb', [root]),
+                         os.path.join(root, 'other'))
+
+    def test_cached_on_disk(self):
+        root = self.makeroot('maps', ['game'], {'aaaa': 'game'})
+        idx = mapdb.index([root])
+        mapdb._indexes.clear()
+        with mock.patch.object(mapdb, '_scan', side_effect=AssertionError):
+            self.assertEqual(mapdb.index([root]), idx)
+
+    def test_lookup_fingerprint(self):
+        romfile = self.writefile('game.nes', inesrom())
+        with open(romfile, 'rb') as f:
+            fingerprint = rom.fingerprint(f)
+        root = self.makeroot('maps', ['game'], {fingerprint: 'game'})
+        self.assertEqual(mapdb.lookup(fingerprint, [root]),
+                         os.path.join(root, 'game'))
+
+
+class TestSimilar(MapDBTestCase):
+    def setUp(self):
+        super().setUp()
+        self.prg = noise(0x8000)
+        self.known = self.writefile('known.nes', inesrom(self.prg))
+        mapdb.learn(self.known, 'maps/game')
+
+    def test_exact(self):
+        self.assertEqual(mapdb.similar(self.known), [(1.0, 'maps/game')])
+
+    def test_modified(self):
+        # Change 4 of the 32 blocks.
+        prg = bytearray(self.prg)
+        for block in 1, 5, 9, 30:
+            prg[block*mapdb.BLOCK_SIZE] ^= 0xFF
+        patched = self.writefile('patched.nes', inesrom(bytes(prg)))
+        self.assertEqual(mapdb.similar(patched), [(28 / 32, 'maps/game')])
+
+    def test_headered(self):
+        data = noise(0x8000, seed=1)
+        plain = self.writefile('plain.sfc', snesrom(data))
+        headered = self.writefile('headered.smc', snesrom(data, smc=True))
+        mapdb.learn(plain, 'maps/snes')
+        self.assertEqual(mapdb.similar(headered), [(1.0, 'maps/snes')])
+
+    def test_best_first(self):
+        prg = bytearray(self.prg)
+        prg[:0x4000] = noise(0x4000, seed=2)
+        other = self.writefile('other.nes', inesrom(bytes(prg)))
+        mapdb.learn(other, 'maps/other')
+        self.assertEqual(mapdb.similar(self.known, limit=2),
+                         [(1.0, 'maps/game'), (0.5, 'maps/other')])
+
+    def test_unrelated(self):
+        unrelated = self.writefile('unrelated.nes',
+                                   inesrom(noise(0x8000, seed=3)))
+        self.assertEqual(mapdb.similar(unrelated), [])
+
+    def test_relearn_updates_map(self):
+        mapdb.learn(self.known, 'maps/renamed')
+        self.assertEqual(mapdb.similar(self.known), [(1.0, 'maps/renamed')])
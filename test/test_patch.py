@@ -1,6 +1,8 @@
+import os
 import unittest
+from unittest import mock
 from collections import OrderedDict
-from tempfile import TemporaryFile, NamedTemporaryFile
+from tempfile import TemporaryFile, NamedTemporaryFile, TemporaryDirectory
 from io import BytesIO, StringIO
 
 import romlib
@@ -37,6 +39,20 @@ class TestPatch(unittest.TestCase):
         p = patch.Patch.from_ips(ips)
         self.assertEqual(changes, p.changes)
 
+    def test_read_ips_records(self):
+        ips = BytesIO(b'PATCH\x00\x00\x02\x00\x01\x03'
+                      b'\x00\x00\x00\x00\x00\x00\x02\xFFEOF')
+        records = list(patch.read_ips(ips))
+        self.assertEqual(records, [(2, b'\x03'), (0, b'\xFF\xFF')])
+
+    def test_from_ips_truncated(self):
+        ips = BytesIO(b'PATCH\x00\x00\x00\x00\x05\x01\x02')
+        self.assertRaises(patch.PatchFormatError, patch.Patch.from_ips, ips)
+
+    def test_from_ips_truncated_rle(self):
+        ips = BytesIO(b'PATCH\x00\x00\x01\x00\x00\x00')
+        self.assertRaises(patch.PatchFormatError, patch.Patch.from_ips, ips)
+
     def test_from_ips_bogus_header(self):
         ips = BytesIO(b'BOGUS\x00\x00\x00'
                       b'\x00\x00\x00\x03'
@@ -101,6 +117,29 @@ class TestPatch(unittest.TestCase):
             f.seek(0)
             self.assertEqual(f.read(), intended_output)
 
+    def test_to_ips_mixed_rle(self):
+        data = b'\x01\x02' + b'\xFF' * 20 + b'\x03'
+        intended_output = b"".join([
+            "PATCH".encode("ascii"),
+            b'\x00\x00\x00\x00\x02\x01\x02',
+            b'\x00\x00\x02\x00\x00\x00\x14\xFF',
+            b'\x00\x00\x16\x00\x01\x03',
+            "EOF".encode("ascii")])
+        p = patch.Patch.from_blocks({0: data})
+        f = BytesIO()
+        p.to_ips(f)
+        self.assertEqual(f.getvalue(), intended_output)
+
+    def test_to_ips_splits_long_blocks(self):
+        changes = {i: i % 3 for i in range(0x10001)}
+        p = patch.Patch(changes)
+        f = BytesIO()
+        p.to_ips(f)
+        f.seek(0)
+        records = list(patch.read_ips(f))
+        self.assertEqual([(o, len(d)) for o, d in records],
+                         [(0, 0xFFFF), (0xFFFF, 2)])
+
     def test_to_ipst(self):
         changes = {0: 1,
                    5: 5,
@@ -152,9 +191,215 @@ class TestPatch(unittest.TestCase):
             p.filter(rom)
         self.assertEqual(p.changes, filtered)
 
+    def test_patch_filter_past_eof(self):
+        p = patch.Patch({1: 0, 2: 0, 3: 0})
+        p.filter(BytesIO(b"\x00\x00"))
+        self.assertEqual(p.changes, {2: 0, 3: 0})
+
+    def test_patch_apply(self):
+        p = patch.Patch({1: 0xAA, 6: 0xBB})
+        with TemporaryFile("wb+") as rom:
+            rom.write(bytes(4))
+            p.apply(rom)
+            rom.seek(0)
+            self.assertEqual(rom.read(), b"\x00\xAA\x00\x00\x00\x00\xBB")
+        rom = BytesIO(bytes(4))
+        p.apply(rom)
+        self.assertEqual(rom.getvalue(), b"\x00\xAA\x00\x00\x00\x00\xBB")
+
     def test_patch_diff(self):
         changes = {1: 0xFF}
         f1 = BytesIO(b'\xDD\xEE')
         f2 = BytesIO(b'\xDD\xFF')
         p = patch.Patch.from_diff(f1, f2)
         self.assertEqual(p.changes, changes)
+
+    def test_patch_diff_uneven_lengths(self):
+        f1 = BytesIO(b'\xDD\xEE\x00\x11')
+        f2 = BytesIO(b'\xDD\xFF\xFF\x00\x00')
+        p = patch.Patch.from_diff(f1, f2)
+        self.assertEqual(p.changes, {1: 0xFF, 2: 0xFF, 3: 0x00})
+        p = patch.Patch.from_diff(BytesIO(b'\x00'), BytesIO(b'\x00\x01'))
+        self.assertEqual(p.changes, {1: 0x01})
+
+
+class TestChangeSet(unittest.TestCase):
+    def test_adjacent_writes_merge(self):
+        changes = patch.ChangeSet()
+        changes.write(0, b"\x01\x02")
+        changes.write(2, b"\x03")
+        changes[3] = 4
+        self.assertEqual(list(changes.blocks()), [(0, b"\x01\x02\x03\x04")])
+
+    def test_overlapping_write_replaces(self):
+        changes = patch.ChangeSet({0: 1, 1: 1, 5: 5})
+        changes.write(1, b"\x02\x02\x02\x02")
+        self.assertEqual(changes, {0: 1, 1: 2, 2: 2, 3: 2, 4: 2, 5: 5})
+        self.assertEqual(len(list(changes.blocks())), 1)
+
+    def test_delete_splits_run(self):
+        changes = patch.ChangeSet.from_blocks({0x10: b"\x01\x02\x03"})
+        del changes[0x11]
+        self.assertEqual(list(changes.blocks()),
+                         [(0x10, b"\x01"), (0x12, b"\x03")])
+        self.assertNotIn(0x11, changes)
+        self.assertRaises(KeyError, changes.__getitem__, 0x11)
+
+    def test_update_later_wins(self):
+        changes = patch.ChangeSet({0: 1, 1: 1})
+        changes.update(patch.ChangeSet({1: 2, 2: 2}))
+        self.assertEqual(changes, {0: 1, 1: 2, 2: 2})
+
+    def test_blocks_range(self):
+        changes = patch.ChangeSet.from_blocks({0: b"abcd", 10: b"efgh"})
+        self.assertEqual(list(changes.blocks(2, 12)),
+                         [(2, b"cd"), (10, b"ef")])
+        self.assertEqual(list(changes.blocks(4, 10)), [])
+        self.assertEqual(list(changes.blocks(11)), [(11, b"fgh")])
+
+
+class TestConvert(unittest.TestCase):
+    def test_convert_too_large_leaves_no_file(self):
+        with TemporaryDirectory() as tmp:
+            infile = os.path.join(tmp, "big.ips32")
+            outfile = os.path.join(tmp, "big.ips")
+            patch.Patch({0x10: 1, 0x01000000: 2}).save(infile)
+            self.assertRaises(patch.PatchValueError, patch.convert,
+                              infile, outfile)
+            self.assertFalse(os.path.exists(outfile))
+
+    def test_save_too_large_leaves_no_file(self):
+        with TemporaryDirectory() as tmp:
+            outfile = os.path.join(tmp, "big.ips")
+            p = patch.Patch({0x01000000: 1})
+            self.assertRaises(patch.PatchValueError, p.save, outfile)
+            self.assertFalse(os.path.exists(outfile))
+
+
+class TestDeltaPatch(unittest.TestCase):
+    def setUp(self):
+        self.source = bytes(range(256)) * 16
+        # Insert some data, which shifts everything after it.
+        self.target = self.source[:100] + b"INSERTED" + self.source[100:]
+        self.patch = patch.Patch.from_diff(BytesIO(self.source),
+                                           BytesIO(self.target))
+
+    def test_bps_roundtrip(self):
+        f = BytesIO()
+        self.patch.to_bps(f, BytesIO(self.source))
+        self.assertLess(len(f.getvalue()), 64)
+        f.seek(0)
+        p = patch.Patch.from_bps(f, BytesIO(self.source))
+        self.assertEqual(p.changes, self.patch.changes)
+
+    def test_ups_roundtrip(self):
+        f = BytesIO()
+        self.patch.to_ups(f, BytesIO(self.source))
+        f.seek(0)
+        p = patch.Patch.from_ups(f, BytesIO(self.source))
+        self.assertEqual(p.changes, self.patch.changes)
+
+    def test_bps_file_roundtrip(self):
+        # Growing the target makes the patch end with a TargetRead, read
+        # straight out of the mapped patch file.
+        changes = patch.ChangeSet(self.patch.changes)
+        changes.write(len(self.source), b"GROWN")
+        with TemporaryDirectory() as tmp:
+            rom = os.path.join(tmp, "source.bin")
+            bps = os.path.join(tmp, "patch.bps")
+            with open(rom, "wb") as f:
+                f.write(self.source)
+            patch.Patch(changes).save(bps, rom=rom)
+            p = patch.Patch.load(bps, rom=rom)
+        self.assertEqual(p.changes, changes)
+
+    def test_change_across_diff_chunks(self):
+        source = bytes(64)
+        target = bytearray(source)
+        target[12:20] = b"\xff" * 8
+        with mock.patch.object(patch, "_DIFF_CHUNK", 16):
+            p = patch.Patch.from_diff(BytesIO(source), BytesIO(target))
+            self.assertEqual(list(p.changes.blocks()), [(12, b"\xff" * 8)])
+            for fmt in "ups", "bps":
+                f = BytesIO()
+                getattr(p, "to_" + fmt)(f, BytesIO(source))
+                f.seek(0)
+                loaded = getattr(patch.Patch, "from_" + fmt)(
+                        f, BytesIO(source))
+                self.assertEqual(loaded.changes, p.changes)
+
+    def test_varint_negative(self):
+        self.assertRaises(ValueError, patch._varint, -1)
+
+    def test_bps_wrong_source(self):
+        f = BytesIO()
+        self.patch.to_bps(f, BytesIO(self.source))
+        f.seek(0)
+        self.assertRaises(patch.PatchValueError, patch.Patch.from_bps,
+                          f, BytesIO(self.target))
+
+    def test_bps_corrupt(self):
+        f = BytesIO()
+        self.patch.to_bps(f, BytesIO(self.source))
+        data = bytearray(f.getvalue())
+        data[6] ^= 0xFF
+        self.assertRaises(patch.PatchFormatError, patch.Patch.from_bps,
+                          BytesIO(data), BytesIO(self.source))
+
+
+class TestMerge(unittest.TestCase):
+    def test_merge_last_wins(self):
+        first = patch.ChangeSet({0: 1, 1: 1, 2: 1, 10: 1})
+        second = patch.ChangeSet({2: 2, 3: 2})
+        conflicts = []
+        merged = list(patch.merge([first.blocks(), second.blocks()],
+                                  conflicts))
+        self.assertEqual(merged, [(0, b"\x01\x01\x02\x02"), (10, b"\x01")])
+        self.assertEqual(conflicts, [(2, 3, [0, 1])])
+
+    def test_merge_agreeing_overlap(self):
+        first = patch.ChangeSet({0: 1, 1: 1})
+        second = patch.ChangeSet({1: 1, 2: 2})
+        conflicts = []
+        merged = list(patch.merge([first.blocks(), second.blocks()],
+                                  conflicts))
+        self.assertEqual(merged, [(0, b"\x01\x01\x02")])
+        self.assertEqual(conflicts, [])
+
+    def test_merge_touching_blocks(self):
+        first = patch.ChangeSet({i: 1 for i in range(0, 100, 2)})
+        second = patch.ChangeSet({i: 2 for i in range(1, 100, 2)})
+        third = patch.ChangeSet({50: 3})
+        conflicts = []
+        merged = list(patch.merge([first.blocks(), second.blocks(),
+                                   third.blocks()], conflicts))
+        expected = bytearray(b"\x01\x02" * 50)
+        expected[50] = 3
+        self.assertEqual(merged, [(0, bytes(expected))])
+        self.assertEqual(conflicts, [(50, 51, [0, 2])])
+
+
+class TestIPS32(unittest.TestCase):
+    def test_ips32_roundtrip(self):
+        changes = {0x01000000: 1, 0x01000001: 2, 0x20: 3}
+        p = patch.Patch(changes)
+        f = BytesIO()
+        p.to_ips32(f)
+        self.assertEqual(f.getvalue(), b"".join([
+            b"IPS32",
+            b"\x00\x00\x00\x20\x00\x01\x03",
+            b"\x01\x00\x00\x00\x00\x02\x01\x02",
+            b"EEOF"]))
+        f.seek(0)
+        self.assertEqual(patch.Patch.from_ips32(f).changes, changes)
+        f.seek(0)
+        self.assertEqual(patch.Patch.from_ips(f).changes, changes)
+
+    def test_ips_too_large(self):
+        p = patch.Patch({0x01000000: 1})
+        f = BytesIO()
+        self.assertRaises(patch.PatchValueError, p.to_ips, f)
+        self.assertEqual(f.getvalue(), b"")
+        blocks = p.changes.blocks()
+        self.assertRaises(patch.PatchValueError,
+                          patch.write_ips, BytesIO(), blocks)
@@ -0,0 +1,101 @@
+import io
+import mmap
+import unittest
+from tempfile import TemporaryFile
+
+from romlib import rom
+
+
+def snesrom(hirom=False, smc=False):
+    """ Build a minimal blank SNES image with a valid internal header."""
+    size = 0x10000 if hirom else 0x8000
+    offset = rom.SNESRom.ofs_hirom if hirom else rom.SNESRom.ofs_lorom
+    data = bytearray(size)
+    header = bytearray(64)
+    header[16:37] = b"TEST ROM".ljust(21)
+    header[37] = 0x21 if hirom else 0x20
+    header[39] = 6 if hirom else 5
+    data[offset:offset+64] = header
+    return (bytes(0x200) if smc else b"") + bytes(data)
+
+
+def inesrom():
+    return b"NES\x1a\x02\x01" + bytes(10) + bytes(0x8000)
+
+
+class CountingFile(io.BytesIO):
+    def __init__(self, data):
+        super().__init__(data)
+        self.nread = 0
+
+    def read(self, size=-1):
+        out = super().read(size)
+        self.nread += len(out)
+        return out
+
+
+class TestDetect(unittest.TestCase):
+    def test_detect_snes(self):
+        for hirom in False, True:
+            for smc in False, True:
+                f = io.BytesIO(snesrom(hirom, smc))
+                romcls, header = rom.detect(f)
+                self.assertIs(romcls, rom.SNESRom)
+                self.assertEqual(header.hirom, hirom)
+                self.assertEqual(header.name.strip(), "TEST ROM")
+
+    def test_detect_ines(self):
+        romcls, header = rom.detect(io.BytesIO(inesrom()))
+        self.assertIs(romcls, rom.INESRom)
+        self.assertEqual(header.sz_prg, 2)
+
+    def test_detect_reads_headers_only(self):
+        f = CountingFile(snesrom(smc=True))
+        rom.detect(f)
+        self.assertLessEqual(f.nread, rom.MAGIC_SIZE + 2*rom.SNESRom.sz_header)
+
+    def test_detect_unknown(self):
+        f = io.BytesIO(bytes(0x8000))
+        self.assertRaises(rom.RomFormatError, rom.detect, f)
+
+    def test_identify(self):
+        self.assertEqual(rom.identify(io.BytesIO(inesrom())), "ines")
+        self.assertEqual(rom.identify(io.BytesIO(snesrom())), "snes")
+
+    def test_fingerprint_ignores_smc(self):
+        plain = rom.fingerprint(io.BytesIO(snesrom()))
+        headered = rom.fingerprint(io.BytesIO(snesrom(smc=True)))
+        self.assertEqual(plain, headered)
+        self.assertTrue(plain.startswith("snes:"))
+        hirom = rom.fingerprint(io.BytesIO(snesrom(hirom=True)))
+        self.assertNotEqual(plain, hirom)
+
+
+class TestRom(unittest.TestCase):
+    def test_make_snes_strips_smc(self):
+        r = rom.Rom.make(io.BytesIO(snesrom(smc=True)))
+        self.assertIsInstance(r, rom.SNESRom)
+        self.assertEqual(len(r.smc), 0x200)
+        self.assertEqual(len(r.data), 0x8000)
+
+    def test_make_ines_strips_header(self):
+        r = rom.Rom.make(io.BytesIO(inesrom()))
+        self.assertIsInstance(r, rom.INESRom)
+        self.assertEqual(len(r.data), 0x8000)
+
+    def test_file_is_mapped(self):
+        with TemporaryFile() as f:
+            f.write(inesrom())
+            with rom.Rom.make(f) as r:
+                self.assertIsInstance(r._buf, mmap.mmap)
+                self.assertEqual(r.data.obj, r._buf)
+                self.assertEqual(r.read(0, 4), bytes(4))
+
+    def test_write_overlay(self):
+        r = rom.Rom.make(io.BytesIO(inesrom()))
+        self.assertEqual(len(r.changes), 0)
+        r.write(2, b"abc")
+        self.assertEqual(r.read(0, 6), b"\0\0abc\0")
+        self.assertEqual(r.read(3, 1), b"b")
+        self.assertEqual(bytes(r.data[2:5]), bytes(3))
+        self.assertRaises(IndexError, r.write, len(r) - 1, b"ab")
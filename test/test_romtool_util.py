@@ -0,0 +1,55 @@
+import os
+import hashlib
+import unittest
+from unittest import mock
+from tempfile import TemporaryDirectory
+
+import romlib.util
+from romtool import util
+
+
+class TestRomHashes(unittest.TestCase):
+    def setUp(self):
+        tmp = TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        env = mock.patch.dict(os.environ, {'XDG_CACHE_HOME': tmp.name})
+        env.start()
+        self.addCleanup(env.stop)
+        self.filename = os.path.join(tmp.name, 'test.rom')
+        self.write(b"original")
+
+    def write(self, data):
+        with open(self.filename, 'wb') as f:
+            f.write(data)
+
+    def hashes(self):
+        """ Get romhashes, and how many times the file was actually hashed."""
+        with mock.patch.object(romlib.util, 'filehashes',
+                               wraps=romlib.util.filehashes) as filehashes:
+            hashes = util.romhashes(self.filename)
+        return hashes, filehashes.call_count
+
+    def test_cache_hit(self):
+        first, count = self.hashes()
+        self.assertEqual(count, 1)
+        self.assertEqual(first['sha1'], hashlib.sha1(b"original").hexdigest())
+        second, count = self.hashes()
+        self.assertEqual(count, 0)
+        self.assertEqual(second, first)
+
+    def test_changed_file_rehashed(self):
+        self.hashes()
+        self.write(b"changed, and longer")
+        hashes, count = self.hashes()
+        self.assertEqual(count, 1)
+        self.assertEqual(hashes['sha1'],
+                         hashlib.sha1(b"changed, and longer").hexdigest())
+
+    def test_stale_row_replaced(self):
+        self.hashes()
+        self.write(b"changed, and longer")
+        hashes, count = self.hashes()
+        rows = list(romlib.util.readtsv(util.cachefile('hashes.tsv')))
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0]['path'], os.path.realpath(self.filename))
+        self.assertEqual(rows[0]['sha1'], hashes['sha1'])
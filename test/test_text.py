@@ -1,3 +1,5 @@
+import io
+import codecs
 import unittest
 from romlib import text
 from tempfile import TemporaryFile
@@ -63,3 +65,170 @@ class TestTextTable(unittest.TestCase):
             f.write(binary)
             f.seek(0)
             self.assertEqual(self.tbl.readstr(f), text)
+
+
+class TestCompiledTable(unittest.TestCase):
+    table = ("/00=[EOS]\n"
+             "41=a\n42=b\n43=c\n20= \n"
+             "80=the\n8041=then\n804142=thenab\n")
+
+    def setUp(self):
+        self.tbl = text.TextTable("test", io.StringIO(self.table))
+
+    def test_decode_longest_match(self):
+        data = bytes([0x80, 0x41, 0x80, 0x41, 0x42, 0x80, 0x20])
+        self.assertEqual(self.tbl.decode(data), ("thenthenabthe ", 7))
+
+    def test_decode_partial_prefix(self):
+        # 0x81 isn't in the table, so the walk has to back up to 0x80.
+        data = bytes([0x80, 0x81])
+        self.assertEqual(self.tbl.decode(data), ("the[$81]", 2))
+
+    def test_decode_eos(self):
+        data = bytes([0x41, 0x00, 0x42])
+        self.assertEqual(self.tbl.decode(data), ("a[EOS]", 2))
+        self.assertEqual(self.tbl.decode(data, include_eos=False), ("a", 2))
+        self.assertEqual(self.tbl.decode(data, stop_on_eos=False),
+                         ("a[EOS]b", 3))
+
+    def test_encode_longest_match(self):
+        self.assertEqual(self.tbl.encode("thenab a"),
+                         (bytes([0x80, 0x41, 0x42, 0x20, 0x41]), 8))
+
+    def test_encode_raw(self):
+        self.assertEqual(self.tbl.encode("a[$F0]b"),
+                         (bytes([0x41, 0xF0, 0x42]), 7))
+
+    def test_encode_miss(self):
+        self.assertRaises(UnicodeEncodeError, self.tbl.encode, "abz")
+
+    def test_encode_eos(self):
+        self.assertEqual(self.tbl.encode("ab", add_eos=True)[0],
+                         bytes([0x41, 0x42, 0x00]))
+        self.assertEqual(self.tbl.encode("ab[EOS]", add_eos=True)[0],
+                         bytes([0x41, 0x42, 0x00]))
+
+
+class TestOptimalEncode(unittest.TestCase):
+    table = ("61=a\n62=b\n63=c\n64=d\n"
+             "90=ab\n91=bcd\n92=xy\n93=yz\n94=x\n")
+
+    def setUp(self):
+        self.tbl = text.TextTable("test", io.StringIO(self.table))
+
+    def test_shorter_than_greedy(self):
+        self.assertEqual(self.tbl.encode("abcd"),
+                         (bytes([0x90, 0x63, 0x64]), 4))
+        self.assertEqual(self.tbl.encode("abcd", optimal=True),
+                         (bytes([0x61, 0x91]), 4))
+
+    def test_greedy_dead_end(self):
+        # Greedy takes "xy" and then has nothing for "z".
+        self.assertRaises(UnicodeEncodeError, self.tbl.encode, "xyz")
+        self.assertEqual(self.tbl.encode("xyz", optimal=True),
+                         (bytes([0x94, 0x93]), 3))
+
+    def test_ties_prefer_longer(self):
+        self.assertEqual(self.tbl.encode("ab", optimal=True),
+                         (bytes([0x90]), 2))
+
+    def test_raw(self):
+        self.assertEqual(self.tbl.encode("a[$F0]bcd", optimal=True),
+                         (bytes([0x61, 0xF0, 0x91]), 9))
+
+    def test_miss(self):
+        with self.assertRaises(UnicodeEncodeError) as cm:
+            self.tbl.encode("abq", optimal=True)
+        self.assertEqual(cm.exception.start, 2)
+
+    def test_codec(self):
+        text.add_tt("optimaltest", io.StringIO(self.table))
+        self.assertEqual("abcd".encode("optimaltest-min"), bytes([0x61, 0x91]))
+        self.assertEqual("abcd".encode("optimaltest-std"),
+                         bytes([0x90, 0x63, 0x64]))
+
+
+class TestIncrementalCodec(unittest.TestCase):
+    table = ("/00=[EOS]\n"
+             "41=a\n42=b\n43=c\n20= \n"
+             "80=the\n8041=then\n804142=thenab\n")
+
+    @classmethod
+    def setUpClass(cls):
+        text.add_tt("streamtest", io.StringIO(cls.table))
+
+    def test_iterdecode_split_code(self):
+        chunks = [b"\x80", b"\x41", b"\x42\x00\x80", b"\x41"]
+        self.assertEqual("".join(codecs.iterdecode(chunks, "streamtest")),
+                         "thenab[EOS]then")
+
+    def test_iterdecode_clean(self):
+        chunks = [b"\x41\x00", b"\x42\x00"]
+        self.assertEqual(
+                "".join(codecs.iterdecode(chunks, "streamtest-clean")), "ab")
+
+    def test_decoder_holds_prefix(self):
+        decoder = codecs.getincrementaldecoder("streamtest")()
+        self.assertEqual(decoder.decode(b"\x41\x80"), "a")
+        self.assertEqual(decoder.decode(b"", final=True), "the")
+
+    def test_streamreader(self):
+        reader = codecs.getreader("streamtest")(
+                io.BytesIO(b"\x80\x41\x42\x00\x80"))
+        out = []
+        while True:
+            chunk = reader.read(1)
+            if not chunk:
+                break
+            out.append(chunk)
+        self.assertEqual("".join(out), "thenab[EOS]the")
+
+    def test_iterencode_split_entry(self):
+        chunks = ["th", "e", "na", "b[", "$F", "0]"]
+        self.assertEqual(b"".join(codecs.iterencode(chunks, "streamtest")),
+                         b"\x80\x41\x42\xF0")
+
+    def test_iterencode_clean(self):
+        chunks = ["a", "b", ""]
+        self.assertEqual(
+                b"".join(codecs.iterencode(chunks, "streamtest-clean")),
+                b"\x41\x42\x00")
+
+
+class TestTableSwitch(unittest.TestCase):
+    kanji = "@Kanji\n8080=\u65e5\n81=\u672c\n"
+    kana = ("@Kana\n41=a\n42=i\n/FF=[END]\n"
+            "!F0=Kanji,2\n!F1=Kanji,0\n!F2=Kanji,-1\n")
+
+    @classmethod
+    def setUpClass(cls):
+        text.add_tt("switchkanji", io.StringIO(cls.kanji))
+        text.add_tt("switchkana", io.StringIO(cls.kana))
+        cls.tbl = text.tt_tables["Kana"]
+
+    def test_counted(self):
+        data = bytes([0x41, 0xF0, 0x80, 0x80, 0x81, 0x41])
+        self.assertEqual(self.tbl.decode(data),
+                         ("a\u65e5\u672ca", 6))
+
+    def test_until_miss(self):
+        data = bytes([0xF1, 0x81, 0x81, 0x41, 0x42])
+        self.assertEqual(self.tbl.decode(data), ("\u672c\u672cai", 5))
+
+    def test_indefinite(self):
+        data = bytes([0xF2, 0x81, 0x41, 0x81])
+        self.assertEqual(self.tbl.decode(data), ("\u672c[$41]\u672c", 4))
+
+    def test_eos_resets(self):
+        data = bytes([0xF0, 0x81, 0xFF, 0x81])
+        self.assertEqual(self.tbl.decode(data, stop_on_eos=False),
+                         ("\u672c[END][$81]", 4))
+
+    def test_iterdecode_keeps_table(self):
+        chunks = [b"\xF1\x80", b"\x80", b"\x81\x41"]
+        self.assertEqual("".join(codecs.iterdecode(chunks, "switchkana")),
+                         "\u65e5\u672ca")
+
+    def test_unknown_table(self):
+        tbl = text.TextTable("lost", io.StringIO("41=a\n!F0=Nowhere,1\n"))
+        self.assertRaises(LookupError, tbl.decode, b"\xF0\x41")
@@ -1,4 +1,7 @@
+import io
+import hashlib
 import unittest
+import zlib
 from collections import OrderedDict
 from tempfile import TemporaryFile, NamedTemporaryFile
 
@@ -46,6 +49,49 @@ class TestUtilFuncs(unittest.TestCase):
         self.assertEqual(util.hexify(4, 5), "0x04")
 
 
+    def test_filehashes_chunked(self):
+        data = bytes(range(256)) * 37
+        with TemporaryFile() as f:
+            f.write(data)
+            hashes = util.filehashes(f, chunksize=100)
+        self.assertEqual(hashes['sha1'], hashlib.sha1(data).hexdigest())
+        self.assertEqual(hashes['md5'], hashlib.md5(data).hexdigest())
+        self.assertEqual(hashes['crc32'], "{:08x}".format(zlib.crc32(data)))
+
+    def test_findruns(self):
+        data = b"\x00" * 20 + b"\xff" * 20 + b"ab" + b"\x00" * 5 + b"\x01" * 17
+        self.assertEqual(list(util.findruns(data, 16)),
+                         [(0, 20, 0), (20, 20, 0xFF), (47, 17, 1)])
+        self.assertEqual(list(util.findruns(data, 5, {0})),
+                         [(0, 20, 0), (42, 5, 0)])
+        self.assertEqual(list(util.findruns(data, 21)), [])
+
+    def test_findruns_singles(self):
+        data = b"a\x00\x00b]]c"
+        self.assertEqual(list(util.findruns(data, 1)),
+                         [(0, 1, 0x61), (1, 2, 0), (3, 1, 0x62),
+                          (4, 2, 0x5D), (6, 1, 0x63)])
+        self.assertEqual(list(util.findruns(data, 1, {0x5D, 0x63})),
+                         [(4, 2, 0x5D), (6, 1, 0x63)])
+
+    def test_profile(self):
+        data = bytes(range(256)) + bytes(256) + b"text" * 64
+        rows = list(util.profile(io.BytesIO(data), window=256, step=128))
+        self.assertEqual([row[0] for row in rows], list(range(0, 768, 128)))
+        self.assertEqual([row[1] for row in rows], [256] * 5 + [128])
+        self.assertAlmostEqual(rows[0][2], 8.0)
+        self.assertAlmostEqual(rows[2][2], 0.0)
+        self.assertAlmostEqual(rows[3][2], 1.75)
+        self.assertAlmostEqual(rows[4][2], 1.5)
+        self.assertEqual(rows[2][3]["zero"], 1.0)
+        self.assertEqual(rows[4][3]["ascii"], 1.0)
+        self.assertAlmostEqual(rows[0][3]["ascii"], 95 / 256)
+
+    def test_profile_bad_step(self):
+        f = io.BytesIO(bytes(16))
+        self.assertRaises(ValueError, list, util.profile(f, 100, 30))
+
+
 class TestOrderedDictReader(unittest.TestCase):
     def test_read_ordereddict_field_order(self):
         with TemporaryFile("w+") as f: